@@ -15,8 +15,9 @@ from .linking import HashTable, TreeFinder, Point, PointND, \
            SubnetOversizeException, link, link_df, link_iter, \
            link_df_iter, strip_diagnostics
 from .filtering import filter_stubs, filter_clusters, filter
-from .feature import locate, batch, percentile_threshold, local_maxima, \
-           refine, estimate_mass, estimate_size, minmass_version_change
+from .feature import locate, batch, batch_iter, percentile_threshold, local_maxima, \
+           refine, refine_batch, estimate_mass, estimate_size, \
+           minmass_version_change, LocatePlan, locate_tiled
 from .preprocessing import bandpass
 from .framewise_data import FramewiseData, PandasHDFStore, PandasHDFStoreBig, \
            PandasHDFStoreSingleNode
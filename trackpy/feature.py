@@ -3,6 +3,8 @@ from __future__ import (absolute_import, division, print_function,
 import six
 import warnings
 import logging
+import functools
+import itertools
 
 import numpy as np
 import pandas as pd
@@ -10,22 +12,33 @@ from scipy import ndimage
 from scipy.spatial import cKDTree
 from pandas import DataFrame
 
-from .preprocessing import bandpass, scale_to_gamut, scalefactor_to_gamut
-from .utils import record_meta, validate_tuple
+from .preprocessing import (bandpass, scale_to_gamut, scalefactor_to_gamut,
+                            _bandpass_to_gamut, _validate_bandpass)
+from .utils import record_meta, validate_tuple, memo
 from .masks import (binary_mask, N_binary_mask, r_squared_mask,
                     x_squared_masks, cosmask, sinmask)
 from .uncertainty import _static_error, measure_noise
+from .parallel import (imap_frames, thread_map, validate_processes,
+                       validate_threads)
 import trackpy  # to get trackpy.__version__
 
-from .try_numba import NUMBA_AVAILABLE
+from .try_numba import NUMBA_AVAILABLE, NUMBA_NOGIL
 from .feature_numba import (_numba_refine_2D, _numba_refine_2D_c,
-                            _numba_refine_2D_c_a, _numba_refine_3D)
+                            _numba_refine_2D_c_a, _numba_refine_3D,
+                            _numba_refine_ND, _numba_local_maxima)
 
 logger = logging.getLogger(__name__)
 
 
 def percentile_threshold(image, percentile):
-    """Find grayscale threshold based on distribution in image."""
+    """Find grayscale threshold based on distribution in image.
+
+    The percentile is taken over the nonzero pixels. For 8- and 16-bit
+    unsigned integer images it is computed from a histogram, in one pass
+    over the image, instead of by (partially) sorting the pixels."""
+    image = np.asarray(image)
+    if image.dtype.kind == 'u' and image.dtype.itemsize <= 2:
+        return _histogram_percentile(image, percentile)
 
     not_black = image[np.nonzero(image)]
     if len(not_black) == 0:
@@ -33,6 +46,24 @@ def percentile_threshold(image, percentile):
     return np.percentile(not_black, percentile)
 
 
+def _histogram_percentile(image, percentile):
+    """Same as np.percentile of the nonzero pixels of an unsigned integer
+    image, with linear interpolation, but from the cumulative histogram."""
+    counts = np.bincount(image.ravel())
+    cumulative = np.cumsum(counts[1:])
+    if len(cumulative) == 0 or cumulative[-1] == 0:
+        return np.nan
+    # The (fractional) position of the percentile among the sorted nonzero
+    # pixels, and the values of its neighbors, as in np.percentile.
+    index = percentile / 100 * (cumulative[-1] - 1)
+    below = int(np.floor(index))
+    above = min(below + 1, cumulative[-1] - 1)
+    value_below, value_above = 1 + np.searchsorted(cumulative, [below, above],
+                                                   side='right')
+    weight_above = index - below
+    return value_below * (1 - weight_above) + value_above * weight_above
+
+
 def minmass_version_change(raw_image, old_minmass, preprocess=True,
                            invert=False, noise_size=1, smoothing_size=None,
                            threshold=None):
@@ -87,7 +118,7 @@ def minmass_version_change(raw_image, old_minmass, preprocess=True,
     return int(old_minmass / scale_factor)
 
 
-def local_maxima(image, radius, percentile=64, margin=None):
+def local_maxima(image, radius, percentile=64, margin=None, engine='auto'):
     """Find local maxima whose brightness is above a given percentile.
 
     Parameters
@@ -96,11 +127,18 @@ def local_maxima(image, radius, percentile=64, margin=None):
     percentile : chooses minimum grayscale value for a local maximum
     margin : zone of exclusion at edges of image. Defaults to radius.
             A smarter value is set by locate().
+    engine : {'auto', 'python', 'numba'}
+        The 'python' engine finds candidates with a fast (separable) maximum
+        filter over a square that fits in the circular neighborhood, then
+        checks the full neighborhood of the candidates only. The 'numba'
+        engine checks each bright pixel in a single pass. Both give the
+        maxima of a grey dilation with a circular footprint.
     """
     if margin is None:
         margin = radius
 
     ndim = image.ndim
+    radius = validate_tuple(radius, ndim)
     # Compute a threshold based on percentile.
     threshold = percentile_threshold(image, percentile)
     if np.isnan(threshold):
@@ -110,10 +148,29 @@ def local_maxima(image, radius, percentile=64, margin=None):
     # The intersection of the image with its dilation gives local maxima.
     if not np.issubdtype(image.dtype, np.integer):
         raise TypeError("Perform dilation on exact (i.e., integer) data.")
-    footprint = binary_mask(radius, ndim)
-    dilation = ndimage.grey_dilation(image, footprint=footprint,
-                                     mode='constant')
-    maxima = np.vstack(np.where((image == dilation) & (image > threshold))).T
+    if engine == 'auto':
+        if NUMBA_AVAILABLE:
+            engine = 'numba'
+        else:
+            engine = 'python'
+    if engine == 'python':
+        maxima = _local_maxima_python(image, radius, threshold)
+    elif engine == 'numba':
+        if not NUMBA_AVAILABLE:
+            warnings.warn("numba could not be imported. Without it, the "
+                          "'numba' engine runs very slow. Use the 'python' "
+                          "engine or install numba.", UserWarning)
+        footprint = binary_mask(radius, ndim)
+        center = np.array(footprint.shape) // 2
+        offsets = np.argwhere(footprint) - center
+        strides = np.cumprod((1,) + image.shape[:0:-1])[::-1]
+        flat_maxima = _numba_local_maxima(
+            np.ravel(image), np.array(image.shape, dtype=np.int64),
+            center.astype(np.int64), threshold, offsets.astype(np.int64),
+            np.dot(offsets, strides).astype(np.int64))
+        maxima = np.column_stack(np.unravel_index(flat_maxima, image.shape))
+    else:
+        raise ValueError("Available engines are 'python' and 'numba'")
     if not np.size(maxima) > 0:
         warnings.warn("Image contains no local maxima.", UserWarning)
         return np.empty((0, ndim))
@@ -130,6 +187,57 @@ def local_maxima(image, radius, percentile=64, margin=None):
     return maxima
 
 
+def _local_maxima_python(image, radius, threshold):
+    """Coordinates of the pixels above threshold that equal the maximum of
+    their circular neighborhood, as in a grey dilation with mode='constant'.
+    """
+    ndim = image.ndim
+    footprint = binary_mask(radius, ndim)
+    center = np.array(footprint.shape) // 2
+    # The largest square (cube) around the center that fits in the footprint
+    # is a cheap, separable first check: a maximum of the footprint must be a
+    # maximum of the square.
+    half_box = np.array([int(r / np.sqrt(ndim)) for r in radius])
+    box_max = ndimage.maximum_filter(image, size=tuple(2*half_box + 1),
+                                     mode='constant')
+    candidates = np.argwhere((image == box_max) & (image > threshold))
+    if len(candidates) == 0:
+        return candidates
+
+    # Check the rest of the footprint at the candidates only.
+    offsets = np.argwhere(footprint) - center
+    offsets = offsets[np.any(np.abs(offsets) > half_box, 1)]
+    shape = np.array(image.shape)
+    interior = np.all((candidates >= center) & (candidates < shape - center), 1)
+    is_max = np.ones(len(candidates), dtype=bool)
+
+    # Away from the edges, gather the neighborhoods through flat indices.
+    strides = np.cumprod((1,) + image.shape[:0:-1])[::-1]
+    flat_image = np.ravel(image)
+    flat_offsets = np.dot(offsets, strides)
+    flat_coords = np.dot(candidates[interior], strides)
+    values = flat_image[flat_coords]
+    chunk = max(1, 2**20 // max(1, len(flat_offsets)))
+    interior_max = np.empty(len(flat_coords), dtype=bool)
+    for start in range(0, len(flat_coords), chunk):
+        stop = start + chunk
+        neighborhood = flat_image[flat_coords[start:stop, np.newaxis] +
+                                  flat_offsets]
+        interior_max[start:stop] = np.all(
+            neighborhood <= values[start:stop, np.newaxis], 1)
+    is_max[interior] = interior_max
+
+    # Near the edges, pixels outside the image count as 0.
+    for i in np.nonzero(~interior)[0]:
+        neighbors = candidates[i] + offsets
+        inside = np.all((neighbors >= 0) & (neighbors < shape), 1)
+        value = image[tuple(candidates[i])]
+        neighborhood = image[tuple(neighbors[inside].T)]
+        is_max[i] = (np.all(neighborhood <= value) and
+                     (np.all(inside) or value >= 0))
+    return candidates[is_max]
+
+
 def estimate_mass(image, radius, coord):
     "Compute the total brightness in the neighborhood of a local maximum."
     square = [slice(c - rad, c + rad + 1) for c, rad in zip(coord, radius)]
@@ -146,6 +254,45 @@ def estimate_size(image, radius, coord, estimated_mass):
     return Rg
 
 
+def _estimate_mass_size(image, radius, coords, size=True):
+    """Compute estimate_mass and (optionally) estimate_size for many local
+    maxima at once.
+
+    The mask neighborhoods of all coords are gathered from the flattened
+    image with one fancy-indexing operation per chunk of coords. This gives
+    the same results as calling estimate_mass and estimate_size in a loop.
+
+    Returns
+    -------
+    mass, size : arrays of length len(coords); size is None if not requested
+    """
+    ndim = image.ndim
+    image = np.ascontiguousarray(image)
+    mask = binary_mask(radius, ndim)
+    offsets = np.array(mask.nonzero()).T - radius  # (N_mask, ndim)
+    strides = np.cumprod((1,) + image.shape[:0:-1])[::-1]
+    flat_offsets = np.dot(offsets, strides)
+    flat_coords = np.dot(np.asarray(coords, dtype=np.intp), strides)
+    if size:
+        r2 = r_squared_mask(radius, ndim)[mask]
+
+    count = len(flat_coords)
+    mass = np.empty(count, dtype=np.float64)
+    rg = np.empty(count, dtype=np.float64) if size else None
+    # Bound the size of the gathered (coords x mask) array.
+    chunk = max(1, 2**20 // len(flat_offsets))
+    flat_image = image.ravel()
+    for start in range(0, count, chunk):
+        stop = start + chunk
+        neighborhoods = flat_image[flat_coords[start:stop, np.newaxis] +
+                                   flat_offsets[np.newaxis, :]]
+        mass[start:stop] = neighborhoods.sum(1)
+        if size:
+            rg[start:stop] = np.sqrt(np.sum(r2 * neighborhoods, 1) /
+                                     mass[start:stop])
+    return mass, rg
+
+
 def _safe_center_of_mass(x, radius, grids):
     normalizer = x.sum()
     if normalizer == 0:  # avoid divide-by-zero errors
@@ -154,9 +301,56 @@ def _safe_center_of_mass(x, radius, grids):
                     for dim in range(x.ndim)])
 
 
+@memo
+def _numba_masks(radius, ndim):
+    """The masks used by the numba engine of refine, flattened to the pixels
+    inside binary_mask: their coordinates (int16, one array per axis), r^2,
+    x^2 per axis (times ndim) and, in 2D, cos and sin of 2 theta."""
+    mask = binary_mask(radius, ndim)
+    masks = dict(coords=np.asarray(np.asarray(mask.nonzero()), dtype=np.int16),
+                 r2=r_squared_mask(radius, ndim)[mask],
+                 x2=[ndim * x2[mask] for x2 in x_squared_masks(radius, ndim)])
+    if ndim == 2:
+        masks['cos'] = cosmask(radius)[mask]
+        masks['sin'] = sinmask(radius)[mask]
+    return masks
+
+
+# What characterize can ask for, in the order of the columns of the results.
+_CHARACTERIZATION = ('size', 'ecc', 'signal', 'raw_mass', 'ep')
+
+
+def _validate_characterize(characterize, allowed=_CHARACTERIZATION):
+    """Interpret the characterize argument: True for all of allowed, False
+    for none, or a list of names. Return the names in the order of
+    allowed."""
+    if characterize is None or isinstance(characterize, (bool, np.bool_)):
+        return tuple(allowed) if characterize else ()
+    if isinstance(characterize, six.string_types):
+        characterize = [characterize]
+    unknown = set(characterize) - set(allowed)
+    if unknown:
+        raise ValueError("Cannot characterize {0}. Choose from {1}.".format(
+            ', '.join(sorted(unknown)), ', '.join(allowed)))
+    return tuple([q for q in allowed if q in characterize])
+
+
+def _refine_columns(quantities, ndim, isotropic):
+    """Indices of the columns of the fully characterized results of refine
+    that hold the coordinates, the mass and the given quantities."""
+    sizes = 1 if isotropic else ndim
+    first = dict(size=ndim + 1, ecc=ndim + 1 + sizes,
+                 signal=ndim + 2 + sizes, raw_mass=ndim + 3 + sizes)
+    columns = list(range(ndim + 1))
+    for q in quantities:
+        width = sizes if q == 'size' else 1
+        columns.extend(range(first[q], first[q] + width))
+    return columns
+
+
 def refine(raw_image, image, radius, coords, separation=0, max_iterations=10,
            engine='auto', shift_thresh=0.6, break_thresh=0.005,
-           characterize=True, walkthrough=False):
+           characterize=True, walkthrough=False, threads=1):
     """Find the center of mass of a bright feature starting from an estimate.
 
     Characterize the neighborhood of a local maximum, and iteratively
@@ -187,17 +381,27 @@ def refine(raw_image, image, radius, coords, separation=0, max_iterations=10,
         Default: 0.005 (unit is pixels).
         When the subpixel refinement along all dimensions is less than this
         number, declare victory and stop refinement.
-    characterize : boolean, True by default
-        Compute and return mass, size, eccentricity, signal.
+    characterize : boolean or list, True by default
+        Compute and return size, eccentricity, signal and raw_mass, after
+        the coordinates and the mass. A list of some of these names
+        ('size', 'ecc', 'signal', 'raw_mass') returns only those columns.
     walkthrough : boolean, False by default
         Print the offset on each loop and display final neighborhood image.
+    threads : integer or 'auto'
+        Number of threads over which the numba engine distributes the
+        features. Default is 1. 'auto' uses one thread per CPU. The results
+        do not depend on it. Numba older than 0.18 cannot release the GIL;
+        with it, one thread is used.
     """
     # ensure that radius is tuple of integers, for direct calls to refine()
     radius = validate_tuple(radius, image.ndim)
     separation = validate_tuple(separation, image.ndim)
+    quantities = _validate_characterize(characterize, _CHARACTERIZATION[:-1])
+    characterize = len(quantities) > 0
     # Main loop will be performed in separate function.
     if engine == 'auto':
-        if NUMBA_AVAILABLE and image.ndim in [2, 3]:
+        # The N-dimensional kernel is only the default on numba >= 0.18.
+        if NUMBA_AVAILABLE and (image.ndim in (2, 3) or NUMBA_NOGIL):
             engine = 'numba'
         else:
             engine = 'python'
@@ -210,106 +414,277 @@ def refine(raw_image, image, radius, coords, separation=0, max_iterations=10,
             warnings.warn("numba could not be imported. Without it, the "
                           "'numba' engine runs very slow. Use the 'python' "
                           "engine or install numba.", UserWarning)
-        if image.ndim not in [2, 3]:
-            raise NotImplementedError("The numba engine only supports 2D or 3D "
-                                      "images. You can extend it if you feel "
-                                      "like a hero.")
         if walkthrough:
             raise ValueError("walkthrough is not availabe in the numba engine")
-        # Do some extra prep in pure Python that can't be done in numba.
         coords = np.array(coords, dtype=np.float64)
         N = coords.shape[0]
-        mask = binary_mask(radius, image.ndim)
-        if image.ndim == 3:
-            if characterize:
-                if np.all(radius[1:] == radius[:-1]):
-                    results_columns = 8
-                else:
-                    results_columns = 10
-            else:
-                results_columns = 4
-            r2_mask = r_squared_mask(radius, image.ndim)[mask]
-            x2_masks = x_squared_masks(radius, image.ndim)
-            z2_mask = image.ndim * x2_masks[0][mask]
-            y2_mask = image.ndim * x2_masks[1][mask]
-            x2_mask = image.ndim * x2_masks[2][mask]
-            results = np.empty((N, results_columns), dtype=np.float64)
-            maskZ, maskY, maskX = np.asarray(np.asarray(mask.nonzero()),
-                                             dtype=np.int16)
-            _numba_refine_3D(np.asarray(raw_image), np.asarray(image),
-                             radius[0], radius[1], radius[2], coords, N,
-                             int(max_iterations), shift_thresh, break_thresh,
-                             characterize,
-                             image.shape[0], image.shape[1], image.shape[2],
-                             maskZ, maskY, maskX, maskX.shape[0],
-                             r2_mask, z2_mask, y2_mask, x2_mask, results)
-        elif not characterize:
-            mask_coordsY, mask_coordsX = np.asarray(mask.nonzero(), dtype=np.int16)
-            results = np.empty((N, 3), dtype=np.float64)
-            _numba_refine_2D(np.asarray(raw_image), np.asarray(image),
-                             radius[0], radius[1], coords, N,
-                             int(max_iterations), shift_thresh, break_thresh,
-                             image.shape[0], image.shape[1],
-                             mask_coordsY, mask_coordsX, mask_coordsY.shape[0],
-                             results)
-        elif radius[0] == radius[1]:
-            mask_coordsY, mask_coordsX = np.asarray(mask.nonzero(), dtype=np.int16)
-            results = np.empty((N, 7), dtype=np.float64)
-            r2_mask = r_squared_mask(radius, image.ndim)[mask]
-            cmask = cosmask(radius)[mask]
-            smask = sinmask(radius)[mask]
-            _numba_refine_2D_c(np.asarray(raw_image), np.asarray(image),
-                               radius[0], radius[1], coords, N,
-                               int(max_iterations), shift_thresh, break_thresh,
-                               image.shape[0], image.shape[1],
-                               mask_coordsY, mask_coordsX, mask_coordsY.shape[0],
-                               r2_mask, cmask, smask, results)
-        else:
-            mask_coordsY, mask_coordsX = np.asarray(mask.nonzero(), dtype=np.int16)
-            results = np.empty((N, 8), dtype=np.float64)
-            x2_masks = x_squared_masks(radius, image.ndim)
-            y2_mask = image.ndim * x2_masks[0][mask]
-            x2_mask = image.ndim * x2_masks[1][mask]
-            cmask = cosmask(radius)[mask]
-            smask = sinmask(radius)[mask]
-            _numba_refine_2D_c_a(np.asarray(raw_image), np.asarray(image),
-                                 radius[0], radius[1], coords, N,
-                                 int(max_iterations), shift_thresh,
-                                 break_thresh, image.shape[0], image.shape[1],
-                                 mask_coordsY, mask_coordsX, mask_coordsY.shape[0],
-                                 y2_mask, x2_mask, cmask, smask, results)
+        kernel, head, tail, results_columns = _numba_refine_setup(
+            raw_image, image, radius, max_iterations, shift_thresh,
+            break_thresh, quantities)
+        results = np.empty((N, results_columns), dtype=np.float64)
+
+        def refine_chunk(bounds):
+            start, stop = bounds
+            kernel(*(head + (coords[start:stop], stop - start) + tail +
+                     (results[start:stop],)))
+
+        # The features are independent: split them over the threads, if
+        # the kernel releases the GIL.
+        threads = validate_threads(threads)
+        if not NUMBA_NOGIL:
+            threads = 1
+        chunk_size = max(-(-N // (4 * threads)), _MIN_REFINE_CHUNK)
+        thread_map(refine_chunk, [(start, min(start + chunk_size, N))
+                                  for start in range(0, N, chunk_size)],
+                   threads)
     else:
         raise ValueError("Available engines are 'python' and 'numba'")
 
+    # The results hold a column for every quantity, or none. Drop those
+    # that were not asked for; the numba kernels have not computed them.
+    if characterize and len(quantities) < len(_CHARACTERIZATION) - 1:
+        results = results[:, _refine_columns(
+            quantities, image.ndim, radius[1:] == radius[:-1])]
+
     # Flat peaks return multiple nearby maxima. Eliminate duplicates.
     if np.all(np.greater(separation, 0)):
-        mass_index = image.ndim  # i.e., index of the 'mass' column
-        while True:
-            # Rescale positions, so that pairs are identified below a distance
-            # of 1. Do so every iteration (room for improvement?)
-            positions = results[:, :mass_index]/list(reversed(separation))
-            mass = results[:, mass_index]
-            duplicates = cKDTree(positions, 30).query_pairs(1)
-            if len(duplicates) == 0:
-                break
-            to_drop = []
-            for p0, p1 in duplicates:
-                # Drop the dimmer one.
-                m0, m1 = mass[p0], mass[p1]
-                if m0 < m1:
-                    to_drop.append(p0)
-                elif m0 > m1:
-                    to_drop.append(p1)
-                else:
-                    # Rare corner case: a tie!
-                    # Break ties by sorting by sum of coordinates, to avoid
-                    # any randomness resulting from cKDTree returning a set.
-                    to_drop.append([p0, p1][np.argmin(np.sum(positions.take([p0, p1], 0), 1))])
-            results = np.delete(results, to_drop, 0)
+        results = _eliminate_duplicates(results, separation, image.ndim)
 
     return results
 
 
+def refine_batch(raw_frames, frames, radius, coords, offsets, separation=0,
+                 max_iterations=10, shift_thresh=0.6, break_thresh=0.005,
+                 characterize=True, threads=1):
+    """Refine the features of many frames of the same shape at once.
+
+    This does the same as calling refine (numba engine) on each frame, but
+    the features of all frames are refined in one compiled call, which
+    saves the overhead of a call per frame. That matters for small frames
+    with few features each.
+
+    Parameters
+    ----------
+    raw_frames : array or list of arrays
+        A stack of frames (the first axis numbers the frames), or a list of
+        equally shaped frames, used for final characterization
+    frames : array or list of arrays
+        processed frames, used for locating center of mass
+    radius : integer or tuple
+    coords : array
+        estimated positions of the features of all frames, frame by frame
+    offsets : array of integers
+        The estimated positions in frame i are
+        ``coords[offsets[i]:offsets[i + 1]]``. The first element is 0 and
+        the last one is len(coords).
+    separation, max_iterations, shift_thresh, break_thresh, characterize
+        See refine.
+    threads : integer or 'auto'
+        Number of threads over which the features are distributed.
+        Default is 1. As in refine, one thread is used with numba < 0.18.
+
+    Returns
+    -------
+    results : array
+        As returned by refine, for the features of all frames
+    offsets : array of integers
+        Where the features of each frame start in results, as above
+
+    See Also
+    --------
+    refine : for a single frame
+    """
+    # A list of frames is stacked here.
+    raw_frames = np.asarray(raw_frames)
+    frames = np.asarray(frames)
+    if raw_frames.shape != frames.shape:
+        raise ValueError("raw_frames and frames must have the same shape")
+    ndim = frames.ndim - 1
+    radius = validate_tuple(radius, ndim)
+    separation = validate_tuple(separation, ndim)
+    quantities = _validate_characterize(characterize, _CHARACTERIZATION[:-1])
+    coords = np.array(coords, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if (len(offsets) != len(frames) + 1 or offsets[0] != 0 or
+            offsets[-1] != len(coords) or np.any(np.diff(offsets) < 0)):
+        raise ValueError("offsets must rise from 0 to len(coords), with one "
+                         "more element than there are frames")
+
+    if not NUMBA_AVAILABLE:
+        warnings.warn("numba could not be imported. Without it, refine_batch "
+                      "calls the 'python' engine of refine frame by frame.",
+                      UserWarning)
+        results = [refine(raw_frames[i], frames[i], radius,
+                          coords[offsets[i]:offsets[i + 1]], separation,
+                          max_iterations, 'python', shift_thresh,
+                          break_thresh, characterize)
+                   for i in range(len(frames))]
+    else:
+        N = coords.shape[0]
+        kernel, head, tail, results_columns = _numba_refine_setup(
+            raw_frames[0], frames[0], radius, max_iterations, shift_thresh,
+            break_thresh, quantities, generic=True)
+        # Point the kernel at the whole stack, and each feature at its frame.
+        head = (np.ascontiguousarray(raw_frames).ravel(),
+                np.ascontiguousarray(frames).ravel()) + head[2:]
+        frame_size = int(np.prod(frames.shape[1:]))
+        frame_offsets = np.repeat(np.arange(len(frames), dtype=np.int64) *
+                                  frame_size, np.diff(offsets))
+        # The last column holds the frame number of each feature.
+        results = np.empty((N, results_columns + 1), dtype=np.float64)
+        results[:, -1] = np.repeat(np.arange(len(frames)), np.diff(offsets))
+
+        def refine_chunk(bounds):
+            start, stop = bounds
+            kernel(*(head + (coords[start:stop], stop - start,
+                             frame_offsets[start:stop]) + tail[1:] +
+                     (results[start:stop],)))
+
+        threads = validate_threads(threads)
+        if not NUMBA_NOGIL:
+            threads = 1
+        chunk_size = max(-(-N // (4 * threads)), _MIN_REFINE_CHUNK)
+        thread_map(refine_chunk, [(start, min(start + chunk_size, N))
+                                  for start in range(0, N, chunk_size)],
+                   threads)
+        if quantities and len(quantities) < len(_CHARACTERIZATION) - 1:
+            results = results[:, _refine_columns(
+                quantities, ndim, radius[1:] == radius[:-1]) + [-1]]
+        if np.all(np.greater(separation, 0)):
+            results = _eliminate_duplicates(results, separation, ndim,
+                                            results[:, -1])
+        counts = np.bincount(results[:, -1].astype(np.int64),
+                             minlength=len(frames))
+        return results[:, :-1], np.cumsum(np.r_[0, counts])
+
+    offsets = np.cumsum([0] + [len(r) for r in results])
+    if len(results) == 0:
+        return np.empty((0, ndim + 1)), offsets
+    return np.concatenate(results), offsets
+
+
+def _numba_refine_setup(raw_image, image, radius, max_iterations,
+                        shift_thresh, break_thresh, quantities,
+                        generic=False):
+    """Choose the numba refine kernel and prepare its arguments.
+
+    quantities holds the names of the quantities to compute, see
+    _validate_characterize. The kernels leave the columns of the other
+    ones unset.
+
+    Returns the kernel, the arguments before the coords and their number,
+    the arguments after them (before the results array), and the number of
+    columns of the results. The 2D and 3D images have their own kernels;
+    all others, or all if generic, use _numba_refine_ND."""
+    # Do some extra prep in pure Python that can't be done in numba.
+    ndim = image.ndim
+    masks = _numba_masks(radius, ndim)
+    raw_image = np.asarray(raw_image)
+    image = np.asarray(image)
+    isotropic = np.all(radius[1:] == radius[:-1])
+    characterize = len(quantities) > 0
+    # Flags for size, ecc, signal and raw_mass, in this order.
+    wanted = np.array([q in quantities for q in _CHARACTERIZATION[:-1]])
+    if not characterize:
+        results_columns = ndim + 1
+    elif isotropic:
+        results_columns = ndim + 5
+    else:
+        results_columns = 2 * ndim + 4
+    max_iterations = int(max_iterations)
+
+    if generic or ndim not in [2, 3]:
+        shape = np.array(image.shape, dtype=np.int64)
+        strides = np.cumprod((1,) + image.shape[:0:-1])[::-1].astype(np.int64)
+        mask_coords = masks['coords']
+        mask_offsets = np.dot(strides, mask_coords.astype(np.int64))
+        if ndim == 2:
+            cmask, smask = masks['cos'], masks['sin']
+        else:
+            cmask = smask = np.empty(0, dtype=np.float64)
+        head = (np.ascontiguousarray(raw_image).ravel(),
+                np.ascontiguousarray(image).ravel(),
+                shape, np.array(radius, dtype=np.int64), strides)
+        tail = (np.zeros(1, dtype=np.int64),  # the offset of the frame
+                max_iterations, shift_thresh, break_thresh, wanted,
+                bool(isotropic), mask_coords, mask_offsets,
+                int(np.dot(strides, radius)), masks['r2'],
+                np.array(masks['x2']), cmask, smask)
+        return _numba_refine_ND, head, tail, results_columns
+
+    # Each kernel takes head, then the coords and their number, then tail,
+    # then the results array.
+    if ndim == 3:
+        maskZ, maskY, maskX = masks['coords']
+        z2_mask, y2_mask, x2_mask = masks['x2']
+        kernel = _numba_refine_3D
+        head = (raw_image, image, radius[0], radius[1], radius[2])
+        tail = (max_iterations, shift_thresh, break_thresh, wanted,
+                image.shape[0], image.shape[1], image.shape[2],
+                maskZ, maskY, maskX, maskX.shape[0],
+                masks['r2'], z2_mask, y2_mask, x2_mask)
+        return kernel, head, tail, results_columns
+
+    mask_coordsY, mask_coordsX = masks['coords']
+    head = (raw_image, image, radius[0], radius[1])
+    tail = (max_iterations, shift_thresh, break_thresh,
+            image.shape[0], image.shape[1],
+            mask_coordsY, mask_coordsX, mask_coordsY.shape[0])
+    if not characterize:
+        kernel = _numba_refine_2D
+    elif isotropic:
+        kernel = _numba_refine_2D_c
+        tail += (masks['r2'], masks['cos'], masks['sin'], wanted)
+    else:
+        kernel = _numba_refine_2D_c_a
+        y2_mask, x2_mask = masks['x2']
+        tail += (y2_mask, x2_mask, masks['cos'], masks['sin'], wanted)
+    return kernel, head, tail, results_columns
+
+
+_MIN_REFINE_CHUNK = 64  # features per call of a numba refine kernel
+
+
+def _eliminate_duplicates(results, separation, ndim, frames=None):
+    """Drop the dimmer feature of each pair closer than separation.
+
+    results has the coordinates (x, y, ...) of the features in its first
+    ndim columns and their mass in the next one.
+
+    Every pair loses its dimmer feature at once, so that no pairs are left
+    afterwards: a feature can be dropped because of a neighbor that is
+    dropped itself. If the frame number of each feature is given, only
+    features of the same frame make pairs."""
+    if len(results) < 2:
+        return results
+    mass_index = ndim  # i.e., index of the 'mass' column
+    # Rescale positions, so that pairs are identified below a distance of 1.
+    positions = results[:, :mass_index]/list(reversed(separation))
+    if frames is not None:
+        # Put the frames far enough apart along an extra axis.
+        positions = np.column_stack([positions, 2 * np.asarray(frames)])
+    tree = cKDTree(positions, 30)
+    try:
+        pairs = tree.query_pairs(1, output_type='ndarray')
+    except TypeError:  # scipy < 0.19
+        pairs = np.array(list(tree.query_pairs(1)), dtype=np.intp)
+    if len(pairs) == 0:
+        return results
+    # Every pair is (p0, p1) with p0 < p1. Their order does not matter.
+    mass = results[:, mass_index]
+    # Rare corner case: a tie! Break ties by the sum of coordinates, to avoid
+    # any randomness resulting from cKDTree returning a set.
+    coord_sum = np.sum(positions, 1)
+    tie_choice = np.argmin([coord_sum[pairs[:, 0]],
+                            coord_sum[pairs[:, 1]]], 0)
+    # Drop the dimmer one.
+    m0, m1 = mass[pairs[:, 0]], mass[pairs[:, 1]]
+    choice = np.where(m0 < m1, 0, np.where(m0 > m1, 1, tie_choice))
+    keep = np.ones(len(results), dtype=bool)
+    keep[pairs[np.arange(len(pairs)), choice]] = False
+    return results[keep]
+
+
 # (This is pure Python. A numba variant follows below.)
 def _refine(raw_image, image, radius, coords, max_iterations,
             shift_thresh, break_thresh, characterize, walkthrough):
@@ -417,7 +792,8 @@ def locate(raw_image, diameter, minmass=None, maxsize=None, separation=None,
            noise_size=1, smoothing_size=None, threshold=None, invert=False,
            percentile=64, topn=None, preprocess=True, max_iterations=10,
            filter_before=True, filter_after=True,
-           characterize=True, engine='auto'):
+           characterize=True, engine='auto', as_array=False,
+           float_dtype=np.float64, threads=1):
     """Locate Gaussian-like blobs of some approximate size in an image.
 
     Preprocess the image by performing a band pass and a threshold.
@@ -474,9 +850,25 @@ def locate(raw_image, diameter, minmass=None, maxsize=None, separation=None,
     filter_after : boolean
         Use final characterizations of mass and size to eliminate spurious
         features. True by default.
-    characterize : boolean
-        Compute "extras": eccentricity, signal, ep. True by default.
+    characterize : boolean or list
+        Compute "extras": size, eccentricity, signal, raw_mass, ep. True by
+        default. A list of some of these names ('size', 'ecc', 'signal',
+        'raw_mass', 'ep') returns only those columns. Leaving out 'ep' saves
+        the measurement of the noise level.
     engine : {'auto', 'python', 'numba'}
+    as_array : boolean
+        Return a numpy structured array, with one float field per column,
+        instead of a DataFrame. False by default.
+    float_dtype : {np.float64, np.float32}
+        dtype of the bandpassed image. np.float32 halves the memory used by
+        the preprocessing, which helps for large 3D stacks. The bandpassed
+        image is then accurate to about 1e-7 of its maximum; after rescaling
+        to integers, a few pixels may differ by one, which shifts positions
+        by far less than their uncertainty. Default is np.float64.
+    threads : integer or 'auto'
+        Number of threads for the numba engine: the bandpass filters and the
+        refinement of the features are split over them. Default is 1. 'auto'
+        uses one thread per CPU. The results do not depend on it.
 
     Returns
     -------
@@ -488,6 +880,7 @@ def locate(raw_image, diameter, minmass=None, maxsize=None, separation=None,
     See Also
     --------
     batch : performs location on many images in batch
+    LocatePlan : performs location on many images of the same shape
     minmass_version_change : to convert minmass from v0.2.4 to v0.3.0
 
     Notes
@@ -504,195 +897,360 @@ def locate(raw_image, diameter, minmass=None, maxsize=None, separation=None,
     .. [1] Crocker, J.C., Grier, D.G. http://dx.doi.org/10.1006/jcis.1996.0217
 
     """
-
-    # Validate parameters and set defaults.
     raw_image = np.squeeze(raw_image)
-    shape = raw_image.shape
-    ndim = len(shape)
-    if filter_before is None:
-        # TODO smarter perf optimization, see GH issue #141
-        filter_before = False
+    plan = LocatePlan(raw_image.shape, raw_image.dtype, diameter, minmass,
+                      maxsize, separation, noise_size, smoothing_size,
+                      threshold, invert, percentile, topn, preprocess,
+                      max_iterations, filter_before, filter_after,
+                      characterize, engine, float_dtype, threads)
+    return plan(raw_image, as_array)
 
-    diameter = validate_tuple(diameter, ndim)
-    diameter = tuple([int(x) for x in diameter])
-    if not np.all([x & 1 for x in diameter]):
-        raise ValueError("Feature diameter must be an odd integer. Round up.")
-    radius = tuple([x//2 for x in diameter])
 
-    isotropic = np.all(radius[1:] == radius[:-1])
-    if (not isotropic) and (maxsize is not None):
-        raise ValueError("Filtering by size is not available for anisotropic "
-                         "features.")
+class LocatePlan(object):
+    """Locate features in many images of the same shape and dtype.
 
-    if separation is None:
-        separation = tuple([x + 1 for x in diameter])
-    else:
-        separation = validate_tuple(separation, ndim)
+    Everything that only depends on the parameters and on the image shape is
+    done once, when the plan is made: validating the parameters, choosing the
+    margins and the output columns. The working arrays of the preprocessing
+    step are allocated on the first call and reused for every image after.
+    Calling the plan on an image returns the same as ``locate`` would.
 
-    if smoothing_size is None:
-        smoothing_size = diameter
-    else:
-        smoothing_size = validate_tuple(smoothing_size, ndim)
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the images (after squeezing out dimensions of length 1)
+    dtype : numpy dtype
+        dtype of the images
+    diameter, minmass, maxsize, separation, noise_size, smoothing_size,
+    threshold, invert, percentile, topn, preprocess, max_iterations,
+    filter_before, filter_after, characterize, engine, float_dtype, threads :
+        see ``locate``
 
-    noise_size = validate_tuple(noise_size, ndim)
+    See Also
+    --------
+    locate
 
-    # Check whether the image looks suspiciously like a color image.
-    if 3 in shape or 4 in shape:
-        dim = raw_image.ndim
-        warnings.warn("I am interpreting the image as {0}-dimensional. "
-                      "If it is actually a {1}-dimensional color image, "
-                      "convert it to grayscale first.".format(dim, dim-1))
+    Notes
+    -----
+    As the working arrays are shared between calls, a plan must not be
+    called from several threads at once. Pickled plans leave them behind.
 
-    if minmass is None:
-        if np.issubdtype(raw_image.dtype, np.integer):
-            minmass = 100
+    Examples
+    --------
+    >>> plan = LocatePlan(frames[0].shape, frames[0].dtype, 11, minmass=200)
+    >>> features = [plan(frame) for frame in frames]
+    """
+    def __init__(self, shape, dtype, diameter, minmass=None, maxsize=None,
+                 separation=None, noise_size=1, smoothing_size=None,
+                 threshold=None, invert=False, percentile=64, topn=None,
+                 preprocess=True, max_iterations=10, filter_before=True,
+                 filter_after=True, characterize=True, engine='auto',
+                 float_dtype=np.float64, threads=1):
+        # Validate parameters and set defaults.
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        ndim = len(shape)
+        if filter_before is None:
+            # TODO smarter perf optimization, see GH issue #141
+            filter_before = False
+
+        diameter = validate_tuple(diameter, ndim)
+        diameter = tuple([int(x) for x in diameter])
+        if not np.all([x & 1 for x in diameter]):
+            raise ValueError("Feature diameter must be an odd integer. Round up.")
+        radius = tuple([x//2 for x in diameter])
+
+        isotropic = np.all(radius[1:] == radius[:-1])
+        if (not isotropic) and (maxsize is not None):
+            raise ValueError("Filtering by size is not available for anisotropic "
+                             "features.")
+
+        if separation is None:
+            separation = tuple([x + 1 for x in diameter])
         else:
-            minmass = 1.
-
-    # Determine `image`: the image to find the local maxima on
-    if preprocess:
-        if invert:
-            # It is tempting to do this in place, but if it is called multiple
-            # times on the same image, chaos reigns.
-            if np.issubdtype(raw_image.dtype, np.integer):
-                max_value = np.iinfo(raw_image.dtype).max
-                raw_image = raw_image ^ max_value
-            else:
-                # To avoid degrading performance, assume gamut is zero to one.
-                # Have you ever encountered an image of unnormalized floats?
-                raw_image = 1 - raw_image
-        image = bandpass(raw_image, noise_size, smoothing_size, threshold)
+            separation = validate_tuple(separation, ndim)
 
-        # Coerce the image into integer type. Rescale to fill dynamic range.
-        if np.issubdtype(raw_image.dtype, np.integer):
-            dtype = raw_image.dtype
+        if smoothing_size is None:
+            smoothing_size = diameter
         else:
-            dtype = np.uint8
-        scale_factor = scalefactor_to_gamut(image, dtype)
-        image = scale_to_gamut(image, dtype, scale_factor)
-    elif np.issubdtype(raw_image.dtype, np.integer):
-        # Do nothing when image is already of integer type
-        scale_factor = 1.
-        image = raw_image
-    else:
-        # Coerce the image into uint8 type. Rescale to fill dynamic range.
-        scale_factor = scalefactor_to_gamut(raw_image, np.uint8)
-        image = scale_to_gamut(raw_image, np.uint8, scale_factor)
+            smoothing_size = validate_tuple(smoothing_size, ndim)
 
-    # Set up a DataFrame for the final results.
-    if image.ndim < 4:
-        coord_columns = ['x', 'y', 'z'][:image.ndim]
-    else:
-        coord_columns = map(lambda i: 'x' + str(i), range(image.ndim))
-    MASS_COLUMN_INDEX = len(coord_columns)
-    columns = coord_columns + ['mass']
-    if characterize:
-        if isotropic:
-            SIZE_COLUMN_INDEX = len(columns)
-            columns += ['size']
-        else:
-            SIZE_COLUMN_INDEX = range(len(columns),
-                                      len(columns) + len(coord_columns))
-            columns += ['size_' + cc for cc in coord_columns]
-        SIGNAL_COLUMN_INDEX = len(columns) + 1
-        columns += ['ecc', 'signal', 'raw_mass']
-        if isotropic and np.all(noise_size[1:] == noise_size[:-1]):
-            columns += ['ep']
-        else:
-            columns += ['ep_' + cc for cc in coord_columns]
-
-    # Find local maxima.
-    # Define zone of exclusion at edges of image, avoiding
-    #   - Features with incomplete image data ("radius")
-    #   - Extended particles that cannot be explored during subpixel
-    #       refinement ("separation")
-    #   - Invalid output of the bandpass step ("smoothing_size")
-    margin = tuple([max(rad, sep // 2 - 1, sm // 2) for (rad, sep, sm) in
-                    zip(radius, separation, smoothing_size)])
-    coords = local_maxima(image, radius, percentile, margin)
-    count_maxima = coords.shape[0]
-
-    if count_maxima == 0:
-        return DataFrame(columns=columns)
-
-    # Proactively filter based on estimated mass/size before
-    # refining positions.
-    if filter_before:
-        approx_mass = np.empty(count_maxima)  # initialize to avoid appending
-        for i in range(count_maxima):
-            approx_mass[i] = estimate_mass(image, radius, coords[i])
-        condition = approx_mass > minmass * scale_factor
-        if maxsize is not None:
-            approx_size = np.empty(count_maxima)
-            for i in range(count_maxima):
-                approx_size[i] = estimate_size(image, radius, coords[i],
-                                               approx_mass[i])
-            condition &= approx_size < maxsize
-        coords = coords[condition]
-    count_qualified = coords.shape[0]
-
-    if count_qualified == 0:
-        warnings.warn("No maxima survived mass- and size-based prefiltering. "
-                      "Be advised that the mass computation was changed from "
-                      "version 0.2.4 to 0.3.0. See the documentation and the "
-                      "convenience function minmass_version_change.")
-        return DataFrame(columns=columns)
-
-    # Refine their locations and characterize mass, size, etc.
-    refined_coords = refine(raw_image, image, radius, coords,
-                            separation=separation, max_iterations=max_iterations,
-                            engine=engine, characterize=characterize)
-    # mass and signal values has to be corrected due to the rescaling
-    # raw_mass was obtained from raw image; size and ecc are scale-independent
-    refined_coords[:, MASS_COLUMN_INDEX] *= 1. / scale_factor
-    if characterize:
-        refined_coords[:, SIGNAL_COLUMN_INDEX] *= 1. / scale_factor
+        noise_size = validate_tuple(noise_size, ndim)
 
-    # Filter again, using final ("exact") mass -- and size, if set.
-    exact_mass = refined_coords[:, MASS_COLUMN_INDEX]
-    if filter_after:
-        condition = exact_mass > minmass
+        # Check whether the image looks suspiciously like a color image.
+        if 3 in shape or 4 in shape:
+            warnings.warn("I am interpreting the image as {0}-dimensional. "
+                          "If it is actually a {1}-dimensional color image, "
+                          "convert it to grayscale first.".format(ndim, ndim-1))
+
+        if minmass is None:
+            if np.issubdtype(dtype, np.integer):
+                minmass = 100
+            else:
+                minmass = 1.
+
+        if preprocess:
+            noise_size, smoothing_size, threshold = _validate_bandpass(
+                ndim, dtype, noise_size, smoothing_size, threshold)
+
+        # Set up the columns of the final results. refine also computes
+        # what filtering by size and the static error need.
+        characterize = _validate_characterize(characterize)
+        refine_quantities = set(characterize) - set(['ep'])
+        if 'ep' in characterize:
+            refine_quantities.add('raw_mass')
         if maxsize is not None:
-            exact_size = refined_coords[:, SIZE_COLUMN_INDEX]
-            condition &= exact_size < maxsize
-        refined_coords = refined_coords[condition]
-        exact_mass = exact_mass[condition]  # used below by topn
-    count_qualified = refined_coords.shape[0]
-
-    if count_qualified == 0:
-        warnings.warn("No maxima survived mass- and size-based filtering. "
-                      "Be advised that the mass computation was changed from "
-                      "version 0.2.4 to 0.3.0. See the documentation and the "
-                      "convenience function minmass_version_change.")
-        return DataFrame(columns=columns)
-
-    if topn is not None and count_qualified > topn:
-        if topn == 1:
-            # special case for high performance and correct shape
-            refined_coords = refined_coords[np.argmax(exact_mass)]
-            refined_coords = refined_coords.reshape(1, -1)
+            refine_quantities.add('size')
+        refine_quantities = tuple([q for q in _CHARACTERIZATION
+                                   if q in refine_quantities])
+        if ndim < 4:
+            coord_columns = ['x', 'y', 'z'][:ndim]
+        else:
+            coord_columns = ['x' + str(i) for i in range(ndim)]
+        self._mass_column = len(coord_columns)
+        columns = coord_columns + ['mass']
+        wanted = list(range(len(columns)))
+        for q in refine_quantities:
+            if q == 'size' and isotropic:
+                self._size_column = len(columns)
+            elif q == 'size':
+                self._size_column = list(range(
+                    len(columns), len(columns) + len(coord_columns)))
+            elif q == 'signal':
+                self._signal_column = len(columns)
+            elif q == 'raw_mass':
+                self._raw_mass_column = len(columns)
+            if q == 'size' and not isotropic:
+                new_columns = ['size_' + cc for cc in coord_columns]
+            else:
+                new_columns = [q]
+            if q in characterize:
+                wanted += range(len(columns), len(columns) + len(new_columns))
+            columns += new_columns
+        if 'ep' in characterize:
+            if isotropic and np.all(noise_size[1:] == noise_size[:-1]):
+                new_columns = ['ep']
+            else:
+                new_columns = ['ep_' + cc for cc in coord_columns]
+            wanted += range(len(columns), len(columns) + len(new_columns))
+            columns += new_columns
+        if len(wanted) < len(columns):
+            self._wanted_columns = wanted
+            columns = [columns[i] for i in wanted]
+        else:
+            self._wanted_columns = None
+
+        # Define zone of exclusion at edges of image, avoiding
+        #   - Features with incomplete image data ("radius")
+        #   - Extended particles that cannot be explored during subpixel
+        #       refinement ("separation")
+        #   - Invalid output of the bandpass step ("smoothing_size")
+        margin = tuple([max(rad, sep // 2 - 1, sm // 2) for (rad, sep, sm) in
+                        zip(radius, separation, smoothing_size)])
+
+        self.shape = shape
+        self.dtype = dtype
+        self.ndim = ndim
+        self.diameter = diameter
+        self.radius = radius
+        self.separation = separation
+        self.noise_size = noise_size
+        self.smoothing_size = smoothing_size
+        self.margin = margin
+        self.columns = columns
+        self.minmass = minmass
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.invert = invert
+        self.percentile = percentile
+        self.topn = topn
+        self.preprocess = preprocess
+        self.max_iterations = max_iterations
+        self.filter_before = filter_before
+        self.filter_after = filter_after
+        self.characterize = characterize
+        self._refine_quantities = refine_quantities
+        self.engine = engine
+        self.float_dtype = np.dtype(float_dtype)
+        self.threads = validate_threads(threads)
+        self._buffers = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_buffers'] = None
+        return state
+
+    def _allocate(self):
+        "Allocate the working arrays of the preprocessing step."
+        if np.issubdtype(self.dtype, np.integer):
+            scaled_dtype = self.dtype
         else:
-            refined_coords = refined_coords[np.argsort(exact_mass)][-topn:]
+            scaled_dtype = np.uint8
+        buffers = dict(bandpass=np.empty(self.shape, dtype=self.float_dtype),
+                       boxcar=np.empty(self.shape, dtype=self.dtype),
+                       scaled=np.empty(self.shape, dtype=scaled_dtype))
+        if self.invert:
+            buffers['inverted'] = np.empty(self.shape, dtype=self.dtype)
+        self._buffers = buffers
+        return buffers
+
+    def _preprocess(self, raw_image, buffers):
+        """Determine `image`: the integer image to find the local maxima on.
+
+        Returns the raw image (inverted if requested), image, and the
+        factor by which image was rescaled to fill its dynamic range."""
+        if not self.preprocess:
+            if np.issubdtype(self.dtype, np.integer):
+                # Do nothing when image is already of integer type
+                return raw_image, raw_image, 1.
+            # Coerce the image into uint8 type. Rescale to fill dynamic range.
+            scale_factor = scalefactor_to_gamut(raw_image, np.uint8)
+            image = scale_to_gamut(raw_image, np.uint8, scale_factor)
+            return raw_image, image, scale_factor
+
+        if self.invert:
+            # Do not do this in place: the image may be used again.
+            if np.issubdtype(self.dtype, np.integer):
+                max_value = np.iinfo(self.dtype).max
+                raw_image = np.bitwise_xor(raw_image, max_value,
+                                           out=buffers['inverted'])
+            else:
+                # To avoid degrading performance, assume gamut is zero
+                # to one. Have you ever encountered an image of
+                # unnormalized floats?
+                raw_image = np.subtract(1, raw_image, out=buffers['inverted'])
 
-    # Estimate the uncertainty in position using signal (measured in refine)
-    # and noise (measured here below).
-    if characterize:
-        if preprocess:  # identify background regions from the processed image
-            black_level, noise = measure_noise(image, raw_image, radius)
-        else:  # identify background regions from the provided image
-            black_level, noise = measure_noise(image, raw_image, radius)
-        Npx = N_binary_mask(radius, ndim)
-        mass = refined_coords[:, SIGNAL_COLUMN_INDEX + 1] - Npx * black_level
-        ep = _static_error(mass, noise, radius[::-1], noise_size[::-1])
-        refined_coords = np.column_stack([refined_coords, ep])
+        # Coerce the image into integer type. Rescale to fill dynamic range.
+        scale_factor = _bandpass_to_gamut(
+            raw_image, self.noise_size, self.smoothing_size, self.threshold,
+            4, buffers['bandpass'], buffers['boxcar'], buffers['scaled'],
+            self.engine, self.threads)
+        return raw_image, buffers['scaled'], scale_factor
+
+    def __call__(self, raw_image, as_array=False):
+        """Locate features in an image.
+
+        Parameters
+        ----------
+        raw_image : array
+            of the shape and dtype the plan was made for
+        as_array : boolean
+            See ``locate``.
+
+        Returns
+        -------
+        DataFrame or structured array, as returned by ``locate``
+        """
+        # If this is a pims Frame object, it has a frame number.
+        frame_no = getattr(raw_image, 'frame_no', None)
+        values = self._locate(raw_image)
+        if as_array:
+            return _to_records(values, self.columns, frame_no)
+        if len(values) == 0:
+            return DataFrame(columns=self.columns)
+
+        f = DataFrame(values, columns=self.columns)
+
+        # Tag on the frame number; this is helpful for parallelization.
+        if frame_no is not None:
+            f['frame'] = frame_no
+        return f
+
+    def _locate(self, raw_image):
+        "Locate features, returning a float array with self.columns."
+        raw_image = np.squeeze(raw_image)
+        if raw_image.shape != self.shape or raw_image.dtype != self.dtype:
+            raise ValueError("This plan is for images of shape {0} and dtype "
+                             "{1}, not {2} and {3}.".format(
+                                 self.shape, self.dtype,
+                                 raw_image.shape, raw_image.dtype))
+        no_features = np.empty((0, len(self.columns)), dtype=np.float64)
+        radius = self.radius
+        buffers = self._buffers
+        if buffers is None:
+            buffers = self._allocate()
+
+        raw_image, image, scale_factor = self._preprocess(raw_image, buffers)
+
+        # Find local maxima.
+        coords = local_maxima(image, radius, self.percentile, self.margin,
+                              self.engine)
+        count_maxima = coords.shape[0]
+
+        if count_maxima == 0:
+            return no_features
+
+        # Proactively filter based on estimated mass/size before
+        # refining positions.
+        if self.filter_before:
+            approx_mass, approx_size = _estimate_mass_size(
+                image, radius, coords, size=self.maxsize is not None)
+            condition = approx_mass > self.minmass * scale_factor
+            if self.maxsize is not None:
+                condition &= approx_size < self.maxsize
+            coords = coords[condition]
+        count_qualified = coords.shape[0]
+
+        if count_qualified == 0:
+            warnings.warn("No maxima survived mass- and size-based prefiltering. "
+                          "Be advised that the mass computation was changed from "
+                          "version 0.2.4 to 0.3.0. See the documentation and the "
+                          "convenience function minmass_version_change.")
+            return no_features
+
+        # Refine their locations and characterize mass, size, etc.
+        refined_coords = refine(raw_image, image, radius, coords,
+                                separation=self.separation,
+                                max_iterations=self.max_iterations,
+                                engine=self.engine,
+                                characterize=self._refine_quantities,
+                                threads=self.threads)
+        # mass and signal values has to be corrected due to the rescaling
+        # raw_mass was obtained from raw image; size and ecc are scale-independent
+        refined_coords[:, self._mass_column] *= 1. / scale_factor
+        if 'signal' in self._refine_quantities:
+            refined_coords[:, self._signal_column] *= 1. / scale_factor
+
+        # Filter again, using final ("exact") mass -- and size, if set.
+        exact_mass = refined_coords[:, self._mass_column]
+        if self.filter_after:
+            condition = exact_mass > self.minmass
+            if self.maxsize is not None:
+                exact_size = refined_coords[:, self._size_column]
+                condition &= exact_size < self.maxsize
+            refined_coords = refined_coords[condition]
+            exact_mass = exact_mass[condition]  # used below by topn
+        count_qualified = refined_coords.shape[0]
+
+        if count_qualified == 0:
+            warnings.warn("No maxima survived mass- and size-based filtering. "
+                          "Be advised that the mass computation was changed from "
+                          "version 0.2.4 to 0.3.0. See the documentation and the "
+                          "convenience function minmass_version_change.")
+            return no_features
+
+        topn = self.topn
+        if topn is not None and count_qualified > topn:
+            if topn == 1:
+                # special case for high performance and correct shape
+                refined_coords = refined_coords[np.argmax(exact_mass)]
+                refined_coords = refined_coords.reshape(1, -1)
+            else:
+                refined_coords = refined_coords[np.argsort(exact_mass)][-topn:]
 
-    f = DataFrame(refined_coords, columns=columns)
+        # Estimate the uncertainty in position using signal (measured in refine)
+        # and noise (measured here below).
+        if 'ep' in self.characterize:
+            # identify background regions from the processed image
+            black_level, noise = measure_noise(image, raw_image, radius)
+            Npx = N_binary_mask(radius, self.ndim)
+            mass = refined_coords[:, self._raw_mass_column] - Npx * black_level
+            ep = _static_error(mass, noise, radius[::-1], self.noise_size[::-1])
+            refined_coords = np.column_stack([refined_coords, ep])
+        if self._wanted_columns is not None:
+            refined_coords = refined_coords[:, self._wanted_columns]
 
-    # If this is a pims Frame object, it has a frame number.
-    # Tag it on; this is helpful for parallelization.
-    if hasattr(raw_image, 'frame_no') and raw_image.frame_no is not None:
-        f['frame'] = raw_image.frame_no
-    return f
+        return refined_coords
 
 
 def batch(frames, diameter, minmass=100, maxsize=None, separation=None,
@@ -700,7 +1258,8 @@ def batch(frames, diameter, minmass=100, maxsize=None, separation=None,
           percentile=64, topn=None, preprocess=True, max_iterations=10,
           filter_before=None, filter_after=True,
           characterize=True, engine='auto',
-          output=None, meta=None):
+          output=None, meta=None, processes=1, as_array=False,
+          float_dtype=np.float64, threads=1):
     """Locate Gaussian-like blobs of some approximate size in a set of images.
 
     Preprocess the image by performing a band pass and a threshold.
@@ -756,8 +1315,11 @@ def batch(frames, diameter, minmass=100, maxsize=None, separation=None,
     filter_after : boolean
         Use final characterizations of mass and size to eliminate spurious
         features. True by default.
-    characterize : boolean
-        Compute "extras": eccentricity, signal, ep. True by default.
+    characterize : boolean or list
+        Compute "extras": size, eccentricity, signal, raw_mass, ep. True by
+        default. A list of some of these names ('size', 'ecc', 'signal',
+        'raw_mass', 'ep') returns only those columns. Leaving out 'ep' saves
+        the measurement of the noise level.
     engine : {'auto', 'python', 'numba'}
     output : {None, trackpy.PandasHDFStore, SomeCustomClass}
         If None, return all results as one big DataFrame. Otherwise, pass
@@ -767,6 +1329,22 @@ def batch(frames, diameter, minmass=100, maxsize=None, separation=None,
         If specified, information relevant to reproducing this batch is saved
         as a YAML file, a plain-text machine- and human-readable format.
         By default, this is None, and no file is saved.
+    processes : integer or 'auto'
+        Number of worker processes over which frames are distributed.
+        Default is 1: all frames are processed in this process. Use 'auto'
+        for one process per CPU. Frames are handed to the workers through
+        shared memory. Results are returned (or passed to ``output``) in the
+        original frame order either way.
+    as_array : boolean
+        Return a numpy structured array, with one float field per column
+        and an integer 'frame' field, instead of a DataFrame. The features
+        are collected in arrays in either case; only the final result is
+        converted. Cannot be combined with ``output``.
+    float_dtype : {np.float64, np.float32}
+        dtype of the bandpassed images. See ``locate``.
+    threads : integer or 'auto'
+        Number of threads used for each frame. See ``locate``. With several
+        processes, keep processes times threads at most the number of CPUs.
 
     Returns
     -------
@@ -778,6 +1356,7 @@ def batch(frames, diameter, minmass=100, maxsize=None, separation=None,
     See Also
     --------
     locate : performs location on a single image
+    batch_iter : yields the features frame by frame
     minmass_version_change : to convert minmass from v0.2.4 to v0.3.0
 
     Notes
@@ -794,6 +1373,93 @@ def batch(frames, diameter, minmass=100, maxsize=None, separation=None,
     .. [1] Crocker, J.C., Grier, D.G. http://dx.doi.org/10.1006/jcis.1996.0217
 
     """
+    if as_array and output is not None:
+        raise ValueError("as_array cannot be used together with output.")
+
+    accumulator = None
+    columns = None
+    for frame_no, values, columns in _batch_arrays(
+            frames, diameter, minmass, maxsize, separation, noise_size,
+            smoothing_size, threshold, invert, percentile, topn,
+            preprocess, max_iterations, filter_before, filter_after,
+            characterize, engine, meta, processes, float_dtype, threads):
+        if len(values) == 0:
+            continue
+
+        if output is None:
+            if accumulator is None:
+                accumulator = _FeatureAccumulator(columns)
+            accumulator.append(values, frame_no)
+        else:
+            output.put(_frame_features(values, columns, frame_no))
+
+    if output is not None:
+        return output
+    if accumulator is None:  # return empty result
+        warnings.warn("No maxima found in any frame.")
+        accumulator = _FeatureAccumulator(columns or [], capacity=0)
+        if not as_array:
+            return pd.DataFrame(columns=accumulator.columns + ['frame'])
+    if as_array:
+        return accumulator.to_records()
+    else:
+        return accumulator.to_dataframe()
+
+
+def batch_iter(frames, diameter, minmass=100, maxsize=None, separation=None,
+               noise_size=1, smoothing_size=None, threshold=None,
+               invert=False, percentile=64, topn=None, preprocess=True,
+               max_iterations=10, filter_before=None, filter_after=True,
+               characterize=True, engine='auto', meta=None, processes=1,
+               float_dtype=np.float64, threads=1):
+    """Locate features in a set of images, yielding them frame by frame.
+
+    This is a generator version of ``batch``. Frames are read and processed
+    only as the features are consumed, so that a long movie can be piped
+    straight into ``link_df_iter`` without holding all its features in
+    memory.
+
+    Parameters
+    ----------
+    frames : list (or iterable) of images
+    diameter, minmass, maxsize, separation, noise_size, smoothing_size,
+    threshold, invert, percentile, topn, preprocess, max_iterations,
+    filter_before, filter_after, characterize, engine, meta, processes,
+    float_dtype, threads :
+        see ``batch``
+
+    Returns
+    -------
+    generator of DataFrames
+        One per frame, with a 'frame' column like the output of ``batch``.
+        Frames without any features are skipped.
+
+    See Also
+    --------
+    batch
+
+    Examples
+    --------
+    >>> features = batch_iter(frames, 11, minmass=200)
+    >>> for linked in link_df_iter(features, search_range=5):
+    ...     store.put(linked)
+    """
+    for frame_no, values, columns in _batch_arrays(
+            frames, diameter, minmass, maxsize, separation, noise_size,
+            smoothing_size, threshold, invert, percentile, topn,
+            preprocess, max_iterations, filter_before, filter_after,
+            characterize, engine, meta, processes, float_dtype, threads):
+        if len(values) > 0:
+            yield _frame_features(values, columns, frame_no)
+
+
+def _batch_arrays(frames, diameter, minmass, maxsize, separation, noise_size,
+                  smoothing_size, threshold, invert, percentile, topn,
+                  preprocess, max_iterations, filter_before, filter_after,
+                  characterize, engine, meta, processes, float_dtype,
+                  threads):
+    """Yield the frame number, feature array and column names of each frame
+    of a batch, also if there are no features."""
     # Gather meta information and save as YAML in current directory.
     timestamp = pd.datetime.utcnow().strftime('%Y-%m-%d-%H%M%S')
     try:
@@ -817,33 +1483,245 @@ def batch(frames, diameter, minmass=100, maxsize=None, separation=None,
             # Interpret meta to be a file handle.
             record_meta(meta_info, meta)
 
+    curried_locate = functools.partial(
+        _batch_locate, diameter=diameter, minmass=minmass, maxsize=maxsize,
+        separation=separation, noise_size=noise_size,
+        smoothing_size=smoothing_size, threshold=threshold, invert=invert,
+        percentile=percentile, topn=topn, preprocess=preprocess,
+        max_iterations=max_iterations, filter_before=filter_before,
+        filter_after=filter_after, characterize=characterize, engine=engine,
+        float_dtype=float_dtype, threads=threads)
+
+    for frame_no, values, columns in _imap_batch(curried_locate, frames,
+                                                 processes):
+        logger.info("Frame %d: %d features", frame_no, len(values))
+        yield frame_no, values, columns
+
+
+def _frame_features(values, columns, frame_no):
+    "The DataFrame of one frame's features, tagged with the frame number."
+    features = DataFrame(values, columns=columns)
+    features['frame'] = frame_no
+    return features
+
+
+def _to_records(values, columns, frame_no=None):
+    """Convert a float array of features to a structured array.
+
+    frame_no, a number or an array with one per feature, is added as an
+    integer 'frame' field unless it is None."""
+    dtype = [(str(c), np.float64) for c in columns]
+    if frame_no is not None:
+        dtype.append((str('frame'), np.int64))
+    records = np.empty(len(values), dtype=dtype)
+    for i, c in enumerate(columns):
+        records[str(c)] = values[:, i]
+    if frame_no is not None:
+        records['frame'] = frame_no
+    return records
+
+
+class _FeatureAccumulator(object):
+    """Collect the feature arrays of many frames.
+
+    The features go into preallocated column buffers, which double in size
+    whenever they are full. The DataFrame or structured array holding all of
+    them is built once, at the end."""
+    def __init__(self, columns, capacity=1024):
+        self.columns = list(columns)
+        self.values = np.empty((capacity, len(self.columns)), dtype=np.float64)
+        self.frames = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, values, frame_no):
+        "Add the features of one frame."
+        n = len(values)
+        if values.shape[1] != len(self.columns):
+            raise ValueError("All frames must have the same dimensions.")
+        if self.size + n > len(self.frames):
+            capacity = max(2 * len(self.frames), self.size + n)
+            new_values = np.empty((capacity, len(self.columns)),
+                                  dtype=np.float64)
+            new_values[:self.size] = self.values[:self.size]
+            new_frames = np.empty(capacity, dtype=np.int64)
+            new_frames[:self.size] = self.frames[:self.size]
+            self.values, self.frames = new_values, new_frames
+        self.values[self.size:self.size + n] = values
+        self.frames[self.size:self.size + n] = frame_no
+        self.size += n
+
+    def to_dataframe(self):
+        return _frame_features(self.values[:self.size], self.columns,
+                               self.frames[:self.size])
+
+    def to_records(self):
+        return _to_records(self.values[:self.size], self.columns,
+                           self.frames[:self.size])
+
+
+def locate_tiled(raw_image, diameter, tile_size, processes=1, **kwargs):
+    """Locate Gaussian-like blobs in an image too large to process at once.
+
+    The image is cut into tiles, each extended by a halo of surrounding
+    pixels, and every tile is processed like ``locate`` processes a whole
+    image. Only the features that fall inside a tile proper, not inside its
+    halo, are kept. Pairs of features closer than ``separation`` across a
+    seam are then resolved as in ``refine``: the brighter one is kept.
+
+    Only a few tiles are in memory at any time, so raw_image may well be a
+    memory-mapped array or an h5py dataset.
+
+    Parameters
+    ----------
+    raw_image : array-like
+        any N-dimensional image that supports slicing, e.g. a numpy.memmap
+    diameter : odd integer or tuple of odd integers
+        See ``locate``.
+    tile_size : integer or tuple of integers
+        Size of the tiles, not counting the halo. May be a tuple, in the
+        same order as the image shape.
+    processes : integer or 'auto'
+        Number of worker processes over which tiles are distributed.
+        Default is 1. Use 'auto' for one process per CPU.
+    **kwargs
+        Passed on to ``locate``: minmass, separation, noise_size, etc.
+
+    Returns
+    -------
+    DataFrame, as returned by ``locate``
+
+    See Also
+    --------
+    locate
+
+    Notes
+    -----
+    The halo is wide enough for the bandpass, the search for local maxima and
+    the refinement of the features of a tile to see the same pixels as they
+    would in the whole image. However, the rescaling of the bandpassed image,
+    the ``percentile`` threshold and the background noise used for ``ep``
+    are determined per tile. Results can therefore differ slightly from
+    ``locate`` on the whole image, mostly for features that are barely
+    brighter than the percentile threshold. ``topn`` applies to the whole
+    image.
+    """
+    shape = tuple(raw_image.shape)
+    ndim = len(shape)
+    tile_size = validate_tuple(tile_size, ndim)
+    topn = kwargs.pop('topn', None)
+
+    # Validate the parameters once, and derive the halo from them.
+    plan = LocatePlan(shape, raw_image.dtype, diameter, **kwargs)
+    support = [max(int(4 * ns + 0.5), sm) for (ns, sm) in
+               zip(plan.noise_size, plan.smoothing_size)]
+    halo = [int(m + r + sup) for (m, r, sup) in
+            zip(plan.margin, plan.radius, support)]
+
+    # For each tile: the origin of its slice and its core, in image
+    # coordinates.
+    origins, core_bounds = [], []
+    for start in itertools.product(*[range(0, n, t) for (n, t) in
+                                     zip(shape, tile_size)]):
+        stop = [min(s + t, n) for (s, t, n) in zip(start, tile_size, shape)]
+        origins.append([max(s - h, 0) for (s, h) in zip(start, halo)])
+        core_bounds.append((start, stop))
+
+    tile_slices = [tuple([slice(o, min(e + h, n)) for (o, e, h, n) in
+                          zip(origin, stop, halo, shape)])
+                   for origin, (start, stop) in zip(origins, core_bounds)]
+
+    def read_tiles():
+        for slices in tile_slices:
+            yield np.asarray(raw_image[slices])
+
+    # Keep a plan for every tile shape. The halos of the tiles near the
+    # edges are cut off, which gives a few shapes per dimension.
+    tile_shapes = set([tuple([s.stop - s.start for s in slices])
+                       for slices in tile_slices])
+    curried_locate = functools.partial(_batch_locate, diameter=diameter,
+                                       **kwargs)
     all_features = []
-    for i, image in enumerate(frames):
-        features = locate(image, diameter, minmass, maxsize, separation,
-                          noise_size, smoothing_size, threshold, invert,
-                          percentile, topn, preprocess, max_iterations,
-                          filter_before, filter_after, characterize,
-                          engine)
-        if hasattr(image, 'frame_no') and image.frame_no is not None:
-            frame_no = image.frame_no
-            # If this works, locate created a 'frame' column.
+    for tile_no, values, columns in _imap_batch(curried_locate, read_tiles(),
+                                                processes, len(tile_shapes)):
+        values = np.asarray(values, dtype=np.float64)
+        # Feature coordinates are ordered (x, y, ...), reverse to shape.
+        values[:, :ndim] += origins[tile_no][::-1]
+        start, stop = core_bounds[tile_no]
+        positions = values[:, :ndim]
+        in_core = np.all((positions >= np.array(start[::-1]) - 0.5) &
+                         (positions < np.array(stop[::-1]) - 0.5), 1)
+        all_features.append(values[in_core])
+
+    results = np.concatenate(all_features)
+    if np.all(np.greater(plan.separation, 0)) and len(results) > 0:
+        results = _eliminate_duplicates(results, plan.separation, ndim)
+
+    if topn is not None and len(results) > topn:
+        mass = results[:, ndim]
+        if topn == 1:
+            results = results[np.argmax(mass)].reshape(1, -1)
         else:
-            frame_no = i
-            features['frame'] = i  # just counting iterations
-        logger.info("Frame %d: %d features", frame_no, len(features))
-        if len(features) == 0:
-            continue
+            results = results[np.argsort(mass)][-topn:]
 
-        if output is None:
-            all_features.append(features)
-        else:
-            output.put(features)
-
-    if output is None:
-        if len(all_features) > 0:
-            return pd.concat(all_features).reset_index(drop=True)
-        else:  # return empty DataFrame
-            warnings.warn("No maxima found in any frame.")
-            return pd.DataFrame(columns=list(features.columns) + ['frame'])
-    else:
-        return output
+    f = DataFrame(results, columns=plan.columns)
+    if hasattr(raw_image, 'frame_no') and raw_image.frame_no is not None:
+        f['frame'] = raw_image.frame_no
+    return f
+
+
+_MAX_BATCH_PLANS = 8  # plans kept by one batch, for frames of other shapes
+_worker_plans = None  # the LocatePlans of a worker process of batch
+
+
+def _init_batch_worker():
+    "Pool initializer: give this worker process its own LocatePlans."
+    global _worker_plans
+    _worker_plans = {}
+
+
+def _imap_batch(func, frames, processes, max_plans=_MAX_BATCH_PLANS):
+    """imap_frames for a partial of _batch_locate.
+
+    The LocatePlans, whose working arrays are reused from frame to frame,
+    belong to this call only: in this process they go into a new dict, and
+    each worker process makes its own when it starts. At most max_plans of
+    them are kept."""
+    func = functools.partial(func, max_plans=max_plans)
+    if validate_processes(processes) == 1:
+        func = functools.partial(func, plans={})
+    return imap_frames(func, frames, processes,
+                       initializer=_init_batch_worker)
+
+
+def _batch_plan(image, plans, max_plans, kwargs):
+    """The LocatePlan for image and the locate arguments kwargs.
+
+    Successive frames of a batch share their plan, unless their shape or
+    dtype changes. Once plans holds max_plans of them, it is emptied."""
+    key = (image.shape, image.dtype.str, repr(sorted(kwargs.items())))
+    try:
+        return plans[key]
+    except KeyError:
+        if len(plans) >= max_plans:
+            plans.clear()
+        plan = LocatePlan(image.shape, image.dtype, **kwargs)
+        plans[key] = plan
+        return plan
+
+
+def _batch_locate(image, plans=None, max_plans=_MAX_BATCH_PLANS, **kwargs):
+    """Locate features in one image of a batch.
+
+    This runs in the worker processes of batch. To keep what is sent back
+    small, it returns the frame number, the feature array and its column
+    names instead of a DataFrame. plans defaults to those of the worker
+    process."""
+    frame_no = image.frame_no
+    image = np.squeeze(image)
+    if plans is None:
+        plans = _worker_plans
+    plan = _batch_plan(image, plans, max_plans, kwargs)
+    return frame_no, plan._locate(image), plan.columns
@@ -2,10 +2,10 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import six
 import numpy as np
-from .try_numba import try_numba_autojit
+from .try_numba import try_numba_autojit, NUMBA_NOGIL
 
 
-@try_numba_autojit(nopython=True)
+@try_numba_autojit(nopython=True, nogil=NUMBA_NOGIL)
 def _numba_refine_2D(raw_image, image, radiusY, radiusX, coords, N,
                      max_iterations, shift_thresh, break_thresh,
                      shapeY, shapeX, maskY, maskX, N_mask, results):
@@ -121,11 +121,15 @@ def _numba_refine_2D(raw_image, image, radiusY, radiusX, coords, N,
 
     return 0  # Unused
 
-@try_numba_autojit(nopython=True)
+@try_numba_autojit(nopython=True, nogil=NUMBA_NOGIL)
 def _numba_refine_2D_c(raw_image, image, radiusY, radiusX, coords, N,
                       max_iterations, shift_thresh, break_thresh,
                       shapeY, shapeX, maskY,
-                      maskX, N_mask, r2_mask, cmask, smask, results):
+                      maskX, N_mask, r2_mask, cmask, smask, wanted, results):
+    # wanted flags the quantities to compute: size, ecc, signal, raw_mass.
+    # The columns of the others are left as they are.
+    do_size, do_ecc, do_signal, do_raw_mass = (wanted[0], wanted[1],
+                                               wanted[2], wanted[3])
     # Column indices into the 'results' array
     MASS_COL = 2
     RG_COL = 3
@@ -244,29 +248,40 @@ def _numba_refine_2D_c(raw_image, image, radiusY, radiusX, coords, N,
                        squareX + maskX[i]]
             mass_ += px
 
-            Rg_ += r2_mask[i]*px
-            ecc1 += cmask[i]*px
-            ecc2 += smask[i]*px
-            raw_mass_ += raw_image[squareY + maskY[i],
-                                   squareX + maskX[i]]
-            if px > signal_:
+            if do_size:
+                Rg_ += r2_mask[i]*px
+            if do_ecc:
+                ecc1 += cmask[i]*px
+                ecc2 += smask[i]*px
+            if do_raw_mass:
+                raw_mass_ += raw_image[squareY + maskY[i],
+                                       squareX + maskX[i]]
+            if do_signal and px > signal_:
                 signal_ = px
-        results[feat, RG_COL] = np.sqrt(Rg_/mass_)
         results[feat, MASS_COL] = mass_
-        center_px = image[squareY + radiusY, squareX + radiusX]
-        results[feat, ECC_COL] = np.sqrt(ecc1**2 + ecc2**2) / (mass_ - center_px + 1e-6)
-        results[feat, SIGNAL_COL] = signal_
-        results[feat, RAW_MASS_COL] = raw_mass_
+        if do_size:
+            results[feat, RG_COL] = np.sqrt(Rg_/mass_)
+        if do_ecc:
+            center_px = image[squareY + radiusY, squareX + radiusX]
+            results[feat, ECC_COL] = np.sqrt(ecc1**2 + ecc2**2) / (mass_ - center_px + 1e-6)
+        if do_signal:
+            results[feat, SIGNAL_COL] = signal_
+        if do_raw_mass:
+            results[feat, RAW_MASS_COL] = raw_mass_
 
     return 0  # Unused
     
 
-@try_numba_autojit(nopython=True)
+@try_numba_autojit(nopython=True, nogil=NUMBA_NOGIL)
 def _numba_refine_2D_c_a(raw_image, image, radiusY, radiusX, coords, N,
                         max_iterations, shift_thresh, break_thresh,
                         shapeY, shapeX, maskY,
                         maskX, N_mask, y2_mask, x2_mask, cmask, smask,
-                        results):
+                        wanted, results):
+    # wanted flags the quantities to compute: size, ecc, signal, raw_mass.
+    # The columns of the others are left as they are.
+    do_size, do_ecc, do_signal, do_raw_mass = (wanted[0], wanted[1],
+                                               wanted[2], wanted[3])
     # Column indices into the 'results' array
     MASS_COL = 2
     RGX_COL = 3
@@ -387,31 +402,42 @@ def _numba_refine_2D_c_a(raw_image, image, radiusY, radiusX, coords, N,
                        squareX + maskX[i]]
             mass_ += px
 
-            RgY += y2_mask[i]*px
-            RgX += x2_mask[i]*px
-            ecc1 += cmask[i]*px
-            ecc2 += smask[i]*px
-            raw_mass_ += raw_image[squareY + maskY[i],
-                                   squareX + maskX[i]]
-            if px > signal_:
+            if do_size:
+                RgY += y2_mask[i]*px
+                RgX += x2_mask[i]*px
+            if do_ecc:
+                ecc1 += cmask[i]*px
+                ecc2 += smask[i]*px
+            if do_raw_mass:
+                raw_mass_ += raw_image[squareY + maskY[i],
+                                       squareX + maskX[i]]
+            if do_signal and px > signal_:
                 signal_ = px
-        results[feat, RGY_COL] = np.sqrt(RgY/mass_)
-        results[feat, RGX_COL] = np.sqrt(RgX/mass_)
         results[feat, MASS_COL] = mass_
-        center_px = image[squareY + radiusY, squareX + radiusX]
-        results[feat, ECC_COL] = np.sqrt(ecc1**2 + ecc2**2) / (mass_ - center_px + 1e-6)
-        results[feat, SIGNAL_COL] = signal_
-        results[feat, RAW_MASS_COL] = raw_mass_
+        if do_size:
+            results[feat, RGY_COL] = np.sqrt(RgY/mass_)
+            results[feat, RGX_COL] = np.sqrt(RgX/mass_)
+        if do_ecc:
+            center_px = image[squareY + radiusY, squareX + radiusX]
+            results[feat, ECC_COL] = np.sqrt(ecc1**2 + ecc2**2) / (mass_ - center_px + 1e-6)
+        if do_signal:
+            results[feat, SIGNAL_COL] = signal_
+        if do_raw_mass:
+            results[feat, RAW_MASS_COL] = raw_mass_
 
     return 0  # Unused
 
 
-@try_numba_autojit(nopython=True)
+@try_numba_autojit(nopython=True, nogil=NUMBA_NOGIL)
 def _numba_refine_3D(raw_image, image, radiusZ, radiusY, radiusX, coords, N,
                      max_iterations, shift_thresh, break_thresh,
-                     characterize, shapeZ, shapeY, shapeX,
+                     wanted, shapeZ, shapeY, shapeX,
                      maskZ, maskY, maskX, N_mask, r2_mask, z2_mask, y2_mask,
                      x2_mask, results):
+    # wanted flags the quantities to compute: size, ecc, signal, raw_mass.
+    # The columns of the others are left as they are.
+    do_size, do_ecc, do_signal, do_raw_mass = (wanted[0], wanted[1],
+                                               wanted[2], wanted[3])
     # Column indices into the 'results' array
     MASS_COL = 3
     isotropic = (radiusX == radiusY and radiusX == radiusZ)
@@ -564,50 +590,245 @@ def _numba_refine_3D(raw_image, image, radiusZ, radiusY, radiusX, coords, N,
         RgX = 0.
         signal_ = 0.
 
-        if not characterize:
-            for i in range(N_mask):
-                px = image[squareZ + maskZ[i],
-                           squareY + maskY[i],
-                           squareX + maskX[i]]
-                mass_ += px
-        elif isotropic:
-            for i in range(N_mask):
-                px = image[squareZ + maskZ[i],
-                           squareY + maskY[i],
-                           squareX + maskX[i]]
-                mass_ += px
+        for i in range(N_mask):
+            px = image[squareZ + maskZ[i],
+                       squareY + maskY[i],
+                       squareX + maskX[i]]
+            mass_ += px
 
+            if do_size and isotropic:
                 Rg_ += r2_mask[i]*px
-                raw_mass_ += raw_image[squareZ + maskZ[i],
-                                       squareY + maskY[i],
-                                       squareX + maskX[i]]
-                if px > signal_:
-                    signal_ = px
-            results[feat, RG_COL] = np.sqrt(Rg_/mass_)
-        else:
-            for i in range(N_mask):
-                px = image[squareZ + maskZ[i],
-                           squareY + maskY[i],
-                           squareX + maskX[i]]
-                mass_ += px
-
+            elif do_size:
                 RgZ += z2_mask[i]*px
                 RgY += y2_mask[i]*px
                 RgX += x2_mask[i]*px
 
+            if do_raw_mass:
                 raw_mass_ += raw_image[squareZ + maskZ[i],
                                        squareY + maskY[i],
                                        squareX + maskX[i]]
-                if px > signal_:
-                    signal_ = px
+            if do_signal and px > signal_:
+                signal_ = px
+
+        results[feat, MASS_COL] = mass_
+        if do_size and isotropic:
+            results[feat, RG_COL] = np.sqrt(Rg_/mass_)
+        elif do_size:
             results[feat, RGZ_COL] = np.sqrt(RgZ/mass_)
             results[feat, RGY_COL] = np.sqrt(RgY/mass_)
             results[feat, RGX_COL] = np.sqrt(RgX/mass_)
+        if do_signal:
+            results[feat, SIGNAL_COL] = signal_
+        if do_ecc:
+            results[feat, ECC_COL] = np.nan
+        if do_raw_mass:
+            results[feat, RAW_MASS_COL] = raw_mass_
+
+    return 0  # Unused
+
+
+@try_numba_autojit(nopython=True)
+def _numba_local_maxima(image, shape, radius, threshold, offsets,
+                        flat_offsets):
+    # image is raveled (C order). A pixel is a local maximum if it is above
+    # threshold and no pixel within the footprint, given by offsets and
+    # flat_offsets, is brighter. Pixels outside the image count as 0, as in
+    # a grey dilation with mode='constant'. The flat indices of the local
+    # maxima are returned, in order. They are collected in a buffer that
+    # doubles in size when it is full, so that its size follows the number
+    # of maxima rather than that of the image.
+    ndim = shape.shape[0]
+    N_offsets = offsets.shape[0]
+    index = np.zeros(ndim, dtype=np.int64)  # multi-index of pixel i
+    maxima = np.empty(1024, dtype=np.int64)
+    count = 0
+    for i in range(image.shape[0]):
+        value = image[i]
+        if value > threshold:
+            interior = True
+            for d in range(ndim):
+                if index[d] < radius[d] or index[d] >= shape[d] - radius[d]:
+                    interior = False
+            is_max = True
+            for k in range(N_offsets):
+                if not interior:
+                    inside = True
+                    for d in range(ndim):
+                        c = index[d] + offsets[k, d]
+                        if c < 0 or c >= shape[d]:
+                            inside = False
+                    if not inside:
+                        if value < 0:
+                            is_max = False
+                            break
+                        continue
+                if image[i + flat_offsets[k]] > value:
+                    is_max = False
+                    break
+            if is_max:
+                if count == maxima.shape[0]:
+                    grown = np.empty(2 * count, dtype=np.int64)
+                    grown[:count] = maxima
+                    maxima = grown
+                maxima[count] = i
+                count += 1
+
+        # Advance the multi-index to pixel i + 1.
+        d = ndim - 1
+        while d >= 0:
+            index[d] += 1
+            if index[d] < shape[d]:
+                break
+            index[d] = 0
+            d -= 1
+    return maxima[:count].copy()
+
+
+@try_numba_autojit(nopython=True, nogil=NUMBA_NOGIL)
+def _numba_refine_ND(raw_image, image, shape, radius, strides, coords, N,
+                     frame_offsets, max_iterations, shift_thresh, break_thresh,
+                     wanted, isotropic, mask_coords, mask_offsets,
+                     center_offset, r2_mask, x2_masks, cmask, smask, results):
+    # The same as the 2D and 3D kernels above, for any number of dimensions.
+    # raw_image and image are raveled; shape, radius and strides (counted in
+    # elements) describe them. mask_coords holds the coordinates of the mask
+    # pixels, one row per dimension; mask_offsets their raveled offsets from
+    # the corner of the mask, and center_offset that of the center. cmask
+    # and smask (for the eccentricity) are only used in 2D. The images may
+    # be a stack of frames: frame_offsets holds the raveled offset of the
+    # frame of each feature, or a single one for all of them. wanted flags
+    # the quantities to compute: size, ecc, signal, raw_mass.
+    do_size, do_ecc, do_signal, do_raw_mass = (wanted[0], wanted[1],
+                                               wanted[2], wanted[3])
+    ndim = shape.shape[0]
+    N_mask = mask_offsets.shape[0]
+    # Column indices into the 'results' array
+    MASS_COL = ndim
+    RG_COL = ndim + 1
+    if isotropic:
+        ECC_COL = RG_COL + 1
+    else:
+        ECC_COL = RG_COL + ndim
+    SIGNAL_COL = ECC_COL + 1
+    RAW_MASS_COL = ECC_COL + 2
+
+    position = np.empty(ndim, dtype=np.float64)
+    cm_n = np.empty(ndim, dtype=np.float64)
+    cm_i = np.empty(ndim, dtype=np.float64)
+    off_center = np.empty(ndim, dtype=np.float64)
+    Rg = np.empty(ndim, dtype=np.float64)
+
+    for feat in range(N):
+        if frame_offsets.shape[0] > 1:
+            frame_offset = frame_offsets[feat]
+        else:
+            frame_offset = frame_offsets[0]
+        # Define the neighborhood of the feature.
+        corner = frame_offset
+        for d in range(ndim):
+            position[d] = coords[feat, d]
+            corner += (int(round(position[d])) - radius[d]) * strides[d]
+            cm_n[d] = 0.
+        mass_ = 0.0
+        for i in range(N_mask):
+            px = image[corner + mask_offsets[i]]
+            for d in range(ndim):
+                cm_n[d] += px*mask_coords[d, i]
+            mass_ += px
+
+        for d in range(ndim):
+            cm_n[d] /= mass_
+            cm_i[d] = cm_n[d] - radius[d] + position[d]
+        for iteration in range(max_iterations):
+            converged = True
+            do_move = False
+            for d in range(ndim):
+                off_center[d] = cm_n[d] - radius[d]
+                if not abs(off_center[d]) < break_thresh:
+                    converged = False
+                if abs(off_center[d]) > shift_thresh:
+                    do_move = True
+            if converged:
+                break  # Go to next feature
+
+            # If we're off by less than half a pixel, we would interpolate.
+            # This is not implemented in numba: stop here.
+            if not do_move:
+                break
+
+            # If we're off by more than half a pixel in any direction, move.
+            corner = frame_offset
+            for d in range(ndim):
+                new_coord = int(round(position[d]))
+                if off_center[d] > shift_thresh:
+                    new_coord += 1
+                elif off_center[d] < - shift_thresh:
+                    new_coord -= 1
+                # Don't move outside the image!
+                if new_coord < radius[d]:
+                    new_coord = radius[d]
+                if new_coord > shape[d] - radius[d] - 1:
+                    new_coord = shape[d] - radius[d] - 1
+                position[d] = new_coord
+                corner += (new_coord - radius[d]) * strides[d]
+                cm_n[d] = 0.
+
+            mass_ = 0.
+            for i in range(N_mask):
+                px = image[corner + mask_offsets[i]]
+                for d in range(ndim):
+                    cm_n[d] += px*mask_coords[d, i]
+                mass_ += px
+
+            for d in range(ndim):
+                cm_n[d] /= mass_
+                cm_i[d] = cm_n[d] - radius[d] + position[d]
+
+        # matplotlib and ndimage have opposite conventions for xy <-> yx.
+        for d in range(ndim):
+            results[feat, d] = cm_i[ndim - 1 - d]
+
+        # Characterize the neighborhood of our final centroid.
+        mass_ = 0.
+        raw_mass_ = 0.
+        Rg_ = 0.
+        for d in range(ndim):
+            Rg[d] = 0.
+        ecc1 = 0.
+        ecc2 = 0.
+        signal_ = 0.
+
+        for i in range(N_mask):
+            px = image[corner + mask_offsets[i]]
+            mass_ += px
+            if do_size and isotropic:
+                Rg_ += r2_mask[i]*px
+            elif do_size:
+                for d in range(ndim):
+                    Rg[d] += x2_masks[d, i]*px
+            if do_ecc and ndim == 2:
+                ecc1 += cmask[i]*px
+                ecc2 += smask[i]*px
+            if do_raw_mass:
+                raw_mass_ += raw_image[corner + mask_offsets[i]]
+            if do_signal and px > signal_:
+                signal_ = px
 
         results[feat, MASS_COL] = mass_
-        if characterize:
-            results[feat, SIGNAL_COL] = signal_
+        if do_size and isotropic:
+            results[feat, RG_COL] = np.sqrt(Rg_/mass_)
+        elif do_size:
+            for d in range(ndim):
+                results[feat, RG_COL + d] = np.sqrt(Rg[ndim - 1 - d]/mass_)
+        if do_ecc and ndim == 2:
+            center_px = image[corner + center_offset]
+            results[feat, ECC_COL] = (np.sqrt(ecc1**2 + ecc2**2) /
+                                      (mass_ - center_px + 1e-6))
+        elif do_ecc:
             results[feat, ECC_COL] = np.nan
+        if do_signal:
+            results[feat, SIGNAL_COL] = signal_
+        if do_raw_mass:
             results[feat, RAW_MASS_COL] = raw_mass_
 
     return 0  # Unused
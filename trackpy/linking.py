@@ -11,9 +11,12 @@ from collections import deque
 
 import numpy as np
 from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import pandas as pd
 
-from .try_numba import try_numba_autojit, NUMBA_AVAILABLE
+from .try_numba import try_numba_autojit, NUMBA_AVAILABLE, NUMBA_NOGIL
+from .parallel import thread_map, validate_threads
 from .utils import is_pandas_since_016, pandas_sort
 
 logger = logging.getLogger(__name__)
@@ -483,7 +486,8 @@ def link_df(features, search_range, memory=0,
             predictor=None, adaptive_stop=None, adaptive_step=0.95,
             copy_features=False, diagnostics=False, pos_columns=None,
             t_column=None, hash_size=None, box_size=None,
-            verify_integrity=True, retain_index=False):
+            verify_integrity=True, retain_index=False, engine='object',
+            threads=1):
     """Link features into trajectories, assigning a label to each trajectory.
 
     Parameters
@@ -538,6 +542,18 @@ def link_df(features, search_range, memory=0,
     retain_index : boolean
         By default, the index is reset to be sequential. To keep the original
         index, set to True. Default is fine unless you devise a special use.
+    engine : {'object', 'array'}
+        'object' (default) makes a Point object per feature. 'array' keeps
+        the positions, candidate links and labels in arrays, which is much
+        faster for many features per frame. It makes the same links, but it
+        does not support predictor, diagnostics or the 'BTree'
+        neighbor_strategy, and it solves subnets with the numba linker,
+        unless link_strategy is 'drop'.
+    threads : integer or 'auto'
+        Number of threads over which the 'array' engine solves the subnets
+        of each frame. Default is 1. 'auto' uses one thread per CPU. The
+        results do not depend on it. With numba older than 0.18, which
+        cannot release the GIL, one thread is used.
 
     Returns
     -------
@@ -551,7 +567,22 @@ def link_df(features, search_range, memory=0,
         pos_columns = ['x', 'y']
     if t_column is None:
         t_column = 'frame'
-    if hash_size is None:
+    if engine not in ['object', 'array']:
+        raise ValueError("engine must be 'object' or 'array'")
+    if engine == 'array' and (predictor is not None or diagnostics or
+                              neighbor_strategy != 'KDTree'):
+        raise ValueError("The 'array' engine does not support predictor, "
+                         "diagnostics or neighbor_strategy='BTree'.")
+    if engine == 'array':
+        # The same strategies as Linker accepts; all but 'drop' are
+        # solved by the compiled subnet solver.
+        link_strategies = ['recursive', 'nonrecursive', 'drop', 'auto']
+        if NUMBA_AVAILABLE:
+            link_strategies.append('numba')
+        if link_strategy not in link_strategies:
+            raise ValueError("link_strategy must be one of: " +
+                             ', '.join(link_strategies))
+    if hash_size is None and engine == 'object':
         MARGIN = 1  # avoid OutOfHashException
         hash_size = features[pos_columns].max() + MARGIN
 
@@ -569,6 +600,12 @@ def link_df(features, search_range, memory=0,
     if retain_index:
         orig_index = features.index.copy()  # Save it; restore it at the end.
     features.reset_index(inplace=True, drop=True)
+    if engine == 'array':
+        return _link_df_array(features, search_range, memory, link_strategy,
+                              adaptive_stop, adaptive_step, copy_features,
+                              pos_columns, t_column, verify_integrity,
+                              orig_index if retain_index else None,
+                              validate_threads(threads))
     levels = _gen_levels_df(features, pos_columns, t_column, diagnostics)
     labeled_levels = link_iter(
         levels, search_range, memory=memory, predictor=predictor,
@@ -614,6 +651,42 @@ def link_df(features, search_range, memory=0,
     return features
 
 
+def _link_df_array(features, search_range, memory, link_strategy,
+                   adaptive_stop, adaptive_step, copy_features, pos_columns,
+                   t_column, verify_integrity, orig_index, threads):
+    "The 'array' engine of link_df, with its arguments validated."
+    if copy_features:
+        features = features.copy()
+    frame_nos = features[t_column].values
+    # Group the features by frame, keeping their order within each frame.
+    order = np.argsort(frame_nos, kind='mergesort')
+    frame_nos_sorted = frame_nos[order]
+    unique_frames, starts = np.unique(frame_nos_sorted, return_index=True)
+    bounds = np.append(starts, len(order))
+    positions = features[pos_columns].values[order]
+    frames = ((frame_no, positions[bounds[i]:bounds[i + 1]])
+              for i, frame_no in enumerate(unique_frames))
+
+    labels = np.empty(len(order), dtype=np.float64)
+    for i, frame_labels in enumerate(_link_array(
+            frames, search_range, memory, link_strategy, adaptive_stop,
+            adaptive_step, threads)):
+        frame_no = unique_frames[i]
+        if verify_integrity:
+            _verify_integrity(frame_no, pd.Series(frame_labels))
+        labels[order[bounds[i]:bounds[i + 1]]] = frame_labels
+        logger.info("Frame %d: %d trajectories present", frame_no,
+                    len(frame_labels))
+    features['particle'] = labels
+
+    if orig_index is not None:
+        features.index = orig_index
+    else:
+        pandas_sort(features, ['particle', t_column], inplace=True)
+        features.reset_index(drop=True, inplace=True)
+    return features
+
+
 def link_df_iter(features, search_range, memory=0,
             neighbor_strategy='KDTree', link_strategy='auto',
             predictor=None, adaptive_stop=None, adaptive_step=0.95,
@@ -1236,14 +1309,42 @@ def assign_candidates(cur_level, prev_hash, search_range, neighbor_strategy):
         if len(cur_level) and len(prev_hash):
             cur_coords = np.array([x.pos for x in cur_level])
             hashpts = prev_hash.points
-            dists, inds = prev_hash.kdtree.query(cur_coords, 10,
-                                                 distance_upper_bound=search_range)
-            nn = np.sum(np.isfinite(dists), 1)  # Number of neighbors of each particle
-            for i, p in enumerate(cur_level):
-                for j in range(nn[i]):
-                    wp = hashpts[inds[i, j]]
-                    p.back_cands.append((wp, dists[i, j]))
-                    wp.forward_cands.append((p, dists[i, j]))
+            rows, inds, dists = _neighbors_within(prev_hash.kdtree, cur_coords,
+                                                  search_range)
+            for i, j, d in zip(rows, inds, dists):
+                p, wp = cur_level[i], hashpts[j]
+                p.back_cands.append((wp, d))
+                wp.forward_cands.append((p, d))
+
+
+def _neighbors_within(tree, coords, search_range, k=10):
+    """Find all points of a cKDTree closer than search_range to coords.
+
+    The k nearest points are queried first. Where all of them are in
+    range, the query is repeated with twice as many, so that dense regions
+    do not lose any candidates.
+
+    Returns
+    -------
+    rows, indices, distances : arrays
+        For each pair, the index into coords, the index of the point of
+        the tree, and their distance
+    """
+    rows = np.arange(len(coords))
+    pairs = []
+    while len(rows):
+        k = min(k, tree.n)
+        dists, inds = tree.query(coords[rows], k,
+                                 distance_upper_bound=search_range)
+        dists = dists.reshape(len(rows), k)  # 1D if k == 1
+        inds = inds.reshape(len(rows), k)
+        crowded = np.isfinite(dists[:, -1]) & (k < tree.n)
+        found = np.isfinite(dists) & ~crowded[:, np.newaxis]
+        pairs.append((np.repeat(rows, np.sum(found, 1)), inds[found],
+                      dists[found]))
+        rows = rows[crowded]
+        k *= 2
+    return tuple(np.concatenate(p) for p in zip(*pairs))
 
 
 class SubnetOversizeException(Exception):
@@ -1429,7 +1530,6 @@ def numba_link(s_sn, dest_size, search_range, max_size=30, diag=False):
     # The basic idea: replace Point objects with integer indices into lists of Points.
     # Then the hard part runs quickly because it is just operating on arrays.
     # We can compile it with numba for outstanding performance.
-    max_candidates = 9  # Max forward candidates we expect for any particle
     src_net = list(s_sn)
     nj = len(src_net) # j will index the source particles
     if nj > max_size:
@@ -1444,14 +1544,13 @@ def numba_link(s_sn, dest_size, search_range, max_size=30, diag=False):
     # A source particle's actual candidates only take up the start of
     # each row of the array. All other elements represent the null link option
     # (i.e. particle lost)
+    # Any number of candidates per particle: the arrays are as wide as needed.
+    max_candidates = max(len(sp.forward_cands) for sp in src_net)
     candsarray = np.ones((nj, max_candidates + 1), dtype=np.int64) * -1
     distsarray = np.ones((nj, max_candidates + 1), dtype=np.float64) * search_range
     ncands = np.zeros((nj,), dtype=np.int64)
     for j, sp in enumerate(src_net):
         ncands[j] = len(sp.forward_cands)
-        if ncands[j] > max_candidates:
-            raise SubnetOversizeException('search_range (aka maxdisp) too large for reasonable performance '
-                                          'on these data (particle has %i forward candidates)' % ncands[j])
         candsarray[j,:ncands[j]] = [dcands_map[cand] for cand, dist in sp.forward_cands]
         distsarray[j,:ncands[j]] = [dist for cand, dist in sp.forward_cands]
     # The assignments are persistent across levels of the recursion
@@ -1472,7 +1571,7 @@ def numba_link(s_sn, dest_size, search_range, max_size=30, diag=False):
     dest_results = [dcands[i] if i >= 0 else None for i in best_assignments]
     return source_results, dest_results
 
-@try_numba_autojit(nopython=True)
+@try_numba_autojit(nopython=True, nogil=NUMBA_NOGIL)
 def _numba_subnet_norecur(ncands, candsarray, dists2array, cur_assignments,
                           cur_sums, tmp_assignments, best_assignments):
     """Find the optimal track assigments for a subnetwork, without recursion.
@@ -1580,5 +1679,267 @@ def drop_link(source_list, dest_size, search_range, max_size=30, diag=False):
     return [sp for sp in source_list], [None,] * len(source_list)
 
 
+def _link_array(frames, search_range, memory=0, link_strategy='auto',
+                adaptive_stop=None, adaptive_step=0.95, threads=1):
+    """Link features into trajectories, keeping everything in arrays.
+
+    This is the 'array' engine of link_df. It makes the same links as
+    Linker, without a Point object per feature: the particles that may
+    continue a trajectory are held in arrays of positions, labels and the
+    frame in which they were last seen.
+
+    Parameters
+    ----------
+    frames : iterable of (frame number, N x d array of positions)
+        in increasing order of frame number
+    search_range, memory, adaptive_stop, adaptive_step : see link_iter
+    link_strategy : {'auto', 'numba', 'drop', ...}
+        'drop' leaves the particles in subnets unlinked. All others solve
+        the subnets with the compiled subnet solver.
+    threads : integer
+        Number of threads over which the subnets of each frame are solved.
+
+    Returns
+    -------
+    generator of arrays with the label of each feature of each frame
+    """
+    if adaptive_stop is not None:
+        max_size = Linker.MAX_SUB_NET_SIZE_ADAPTIVE
+    else:
+        max_size = Linker.MAX_SUB_NET_SIZE
+    if link_strategy == 'drop':
+        solver = functools.partial(_drop_link_array, threads=threads)
+    else:
+        solver = functools.partial(_numba_link_array, threads=threads)
+
+    # The particles that can be linked to: their positions, labels and
+    # the frames in which they were last seen.
+    src_pos = src_label = src_frame = None
+    next_label = 0
+    for frame_no, pos in frames:
+        pos = np.asarray(pos, dtype=np.float64)
+        if src_pos is None:
+            src_pos = np.empty((0, pos.shape[1]), dtype=np.float64)
+            src_label = np.empty(0, dtype=np.int64)
+            src_frame = np.empty(0, dtype=np.int64)
+        # Forget the particles that have been lost for too long.
+        keep = frame_no - src_frame <= memory + 1
+        src_pos, src_label = src_pos[keep], src_label[keep]
+        src_frame = src_frame[keep]
+
+        match = np.full(len(pos), -1, dtype=np.int64)
+        if len(pos) and len(src_pos):
+            back, fwd = _candidate_graph(src_pos, pos, search_range)
+            subnet_sizes = _assign_links_array(
+                back, fwd, search_range, match, solver, max_size,
+                adaptive_stop, adaptive_step)
+            if logger.isEnabledFor(logging.DEBUG) and len(subnet_sizes):
+                logger.debug("Frame %d: %d subnets. Number of subnets by "
+                             "number of source particles: %s", frame_no,
+                             len(subnet_sizes), np.bincount(subnet_sizes))
+        linked = match >= 0
+        labels = np.empty(len(pos), dtype=np.int64)
+        labels[linked] = src_label[match[linked]]
+        # Unclaimed destination particles start new trajectories.
+        new_count = len(pos) - np.count_nonzero(linked)
+        labels[~linked] = np.arange(next_label, next_label + new_count)
+        next_label += new_count
+        # Unclaimed source particles are remembered.
+        lost = np.ones(len(src_pos), dtype=bool)
+        lost[match[linked]] = False
+        src_pos = np.concatenate([pos, src_pos[lost]])
+        src_label = np.concatenate([labels, src_label[lost]])
+        src_frame = np.concatenate([np.full(len(pos), frame_no,
+                                            dtype=np.int64),
+                                    src_frame[lost]])
+        yield labels
+
+
+def _candidate_graph(source_pos, dest_pos, search_range):
+    """Find the candidate links between two frames with a KD-tree.
+
+    Returns the graph of the candidates twice: as the candidate sources
+    of each destination particle, and as the candidate destinations of
+    each source particle. See _graph_from_pairs.
+    """
+    pair_dest, pair_src, pair_dist = _neighbors_within(
+        cKDTree(source_pos, 15), dest_pos, search_range)
+    return _graph_from_pairs(pair_dest, pair_src, pair_dist,
+                             len(dest_pos), len(source_pos))
+
+
+def _graph_from_pairs(pair_dest, pair_src, pair_dist, n_dest, n_src):
+    """Store candidate links as a sparse bipartite graph.
+
+    Returns (back, fwd), both in CSR layout as (offsets, indices,
+    distances): the candidate sources of destination i are
+    back[1][back[0][i]:back[0][i + 1]], at distances back[2][...] in
+    increasing order. Likewise, fwd holds the candidate destinations of
+    each source.
+    """
+    graphs = []
+    for rows, cols, count in [(pair_dest, pair_src, n_dest),
+                              (pair_src, pair_dest, n_src)]:
+        order = np.lexsort((pair_dist, rows))
+        offsets = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=count), out=offsets[1:])
+        graphs.append((offsets, np.asarray(cols[order], dtype=np.int64),
+                       pair_dist[order]))
+    return tuple(graphs)
+
+
+def _assign_links_array(back, fwd, search_range, match, solver, max_size=30,
+                        adaptive_stop=None, adaptive_step=0.95):
+    """Match destination particles with source particles.
+
+    back and fwd are the candidate graph, see _graph_from_pairs. match
+    holds the source of each destination particle, or -1. It is filled in
+    for the destinations that have candidates. solver is called once,
+    with all subnets of at most max_size source particles.
+
+    Returns the number of source particles in each subnet.
+    """
+    back_offsets, back_src, _ = back
+    fwd_offsets, fwd_dest, fwd_dist = fwd
+    n_back = np.diff(back_offsets)
+    n_fwd = np.diff(fwd_offsets)
+    n_dest, n_src = len(n_back), len(n_fwd)
+    # Each subnet is a connected component of the candidate graph, with
+    # the destinations as its first nodes and the sources after them.
+    pair_dest = np.repeat(np.arange(n_dest), n_back)
+    graph = coo_matrix((np.ones(len(back_src)),
+                        (pair_dest, n_dest + back_src)),
+                       shape=(n_dest + n_src,) * 2)
+    n_components, component = connected_components(graph, directed=False)
+    component_dest = component[:n_dest][n_back > 0]
+    linkable = np.nonzero(n_fwd > 0)[0]
+    component_src = component[n_dest + linkable]
+    dest_count = np.bincount(component_dest, minlength=n_components)
+    src_count = np.bincount(component_src, minlength=n_components)
+
+    # A single source and a single destination are simply linked.
+    single = (src_count == 1)[component_src] & \
+        (dest_count == 1)[component_src]
+    match[fwd_dest[fwd_offsets[linkable[single]]]] = linkable[single]
+
+    order = np.argsort(component_src, kind='mergesort')
+    linkable, component_src = linkable[order], component_src[order]
+    subnets = np.nonzero((src_count > 1) | (dest_count > 1))[0]
+    bounds = np.searchsorted(component_src, subnets)
+    oversize = src_count[subnets] > max_size
+    for start, stop in zip(bounds[oversize],
+                           bounds[oversize] + src_count[subnets[oversize]]):
+        if adaptive_stop is None or search_range <= adaptive_stop:
+            raise SubnetOversizeException(
+                'search_range (aka maxdisp) too large for reasonable '
+                'performance on these data (sub net contains %d points)'
+                % (stop - start))
+        # Retry the subnet with the candidates in a reduced range.
+        new_range = search_range * adaptive_step
+        pairs = np.concatenate([np.arange(fwd_offsets[sp], fwd_offsets[sp + 1])
+                                for sp in linkable[start:stop]])
+        pairs = pairs[fwd_dist[pairs] <= new_range]
+        pair_src = np.repeat(np.arange(n_src), n_fwd)[pairs]
+        sub_back, sub_fwd = _graph_from_pairs(
+            fwd_dest[pairs], pair_src, fwd_dist[pairs], n_dest, n_src)
+        _assign_links_array(sub_back, sub_fwd, new_range, match, solver,
+                            max_size, adaptive_stop, adaptive_step)
+
+    # Solve all other subnets at once. They share no particles, so the
+    # order in which they are solved does not matter.
+    solvable = ((src_count > 1) | (dest_count > 1)) & (src_count <= max_size)
+    sources = linkable[solvable[component_src]]
+    if len(sources):
+        subnet_bounds = np.zeros(np.count_nonzero(solvable) + 1,
+                                 dtype=np.int64)
+        np.cumsum(src_count[solvable], out=subnet_bounds[1:])
+        dests = solver(sources, subnet_bounds, fwd, search_range)
+        linked = dests >= 0
+        match[dests[linked]] = sources[linked]
+    return src_count[subnets]
+
+
+def _numba_link_array(sources, bounds, fwd, search_range, threads=1):
+    """Find the optimal links of the source particles of many subnets.
+
+    The source particles of subnet k are sources[bounds[k]:bounds[k + 1]].
+    fwd holds the candidate destinations of each source particle, see
+    _graph_from_pairs. Returns the chosen destination of each of sources,
+    or -1. The subnets are split over the given number of threads; the
+    result does not depend on it.
+    """
+    offsets, dest, dist = fwd
+    dests = np.empty(len(sources), dtype=np.int64)
+    n = len(bounds) - 1
+
+    def solve_chunk(chunk):
+        start, stop = chunk
+        _numba_subnets(bounds[start:stop + 1], sources, offsets, dest, dist,
+                       float(search_range), dests)
+
+    if not NUMBA_NOGIL:
+        threads = 1  # the solver would hold the GIL
+    chunk_size = max(-(-n // (4 * threads)), _MIN_SUBNET_CHUNK)
+    thread_map(solve_chunk, [(start, min(start + chunk_size, n))
+                             for start in range(0, n, chunk_size)], threads)
+    return dests
+
+
+def _drop_link_array(sources, bounds, fwd, search_range, threads=1):
+    """Leave all source particles of the subnets unlinked; see drop_link."""
+    return np.full(len(sources), -1, dtype=np.int64)
+
+
+_MIN_SUBNET_CHUNK = 256  # subnets per call of _numba_subnets
+
+
+@try_numba_autojit(nopython=True, nogil=NUMBA_NOGIL)
+def _numba_subnets(bounds, sources, fwd_offsets, fwd_dest, fwd_dist,
+                   search_range, dests):
+    """Solve the subnets sources[bounds[k]:bounds[k + 1]] one by one.
+
+    The chosen destination of each source particle, or -1, is written to
+    the same position in dests.
+    """
+    null_dist2 = search_range * search_range
+    for k in range(bounds.shape[0] - 1):
+        start = bounds[k]
+        nj = bounds[k + 1] - start
+        ncands = np.empty(nj, dtype=np.int64)
+        width = 0
+        for j in range(nj):
+            sp = sources[start + j]
+            # including the null link
+            ncands[j] = fwd_offsets[sp + 1] - fwd_offsets[sp] + 1
+            if ncands[j] > width:
+                width = ncands[j]
+        # A source particle's actual candidates only take up the start of
+        # each row of the array. The next element is the null link option
+        # (i.e. particle lost), as are all others.
+        candsarray = np.empty((nj, width + 1), dtype=np.int64)
+        dists2array = np.empty((nj, width + 1), dtype=np.float64)
+        for j in range(nj):
+            first = fwd_offsets[sources[start + j]]
+            for i in range(width + 1):
+                if i < ncands[j] - 1:
+                    candsarray[j, i] = fwd_dest[first + i]
+                    dists2array[j, i] = fwd_dist[first + i]**2
+                else:
+                    candsarray[j, i] = -1
+                    dists2array[j, i] = null_dist2
+        best_assignments = np.empty(nj, dtype=np.int64)
+        cur_assignments = np.empty(nj, dtype=np.int64)
+        tmp_assignments = np.zeros(nj, dtype=np.int64)
+        cur_sums = np.zeros(nj, dtype=np.float64)
+        for j in range(nj):
+            best_assignments[j] = -1
+            cur_assignments[j] = -1
+        _numba_subnet_norecur(ncands, candsarray, dists2array,
+                              cur_assignments, cur_sums, tmp_assignments,
+                              best_assignments)
+        for j in range(nj):
+            dests[start + j] = best_assignments[j]
+
+
 sub_net_linker = SubnetLinker  # legacy
 Hash_table = HashTable  # legacy
@@ -0,0 +1,311 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import six
+from six.moves import queue
+import atexit
+import functools
+import itertools
+import os
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from pims import Frame
+
+
+def cpu_count():
+    "Number of CPUs, or 1 if it cannot be determined."
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def validate_processes(processes):
+    """Interpret the 'processes' argument of batch and friends.
+
+    Parameters
+    ----------
+    processes : integer, 'auto' or None
+        'auto' and None mean one process per CPU.
+
+    Returns
+    -------
+    integer number of processes (at least 1)
+    """
+    return _validate_count(processes, 'processes')
+
+
+def validate_threads(threads):
+    """Interpret the 'threads' argument of bandpass and friends.
+
+    Parameters
+    ----------
+    threads : integer, 'auto' or None
+        'auto' and None mean one thread per CPU.
+
+    Returns
+    -------
+    integer number of threads (at least 1)
+    """
+    return _validate_count(threads, 'threads')
+
+
+def _validate_count(count, what):
+    if count is None or count == 'auto':
+        return cpu_count()
+    count = int(count)
+    if count < 1:
+        raise ValueError("The number of {0} must be at least 1.".format(what))
+    return count
+
+
+_thread_pool = None  # (process id, number of threads, ThreadPool)
+_thread_pool_lock = (os.getpid(), threading.Lock())  # (process id, Lock)
+
+
+def _get_thread_pool_lock():
+    """The lock that guards _thread_pool. A forked process gets a new one:
+    another thread may have held the old one at the fork."""
+    global _thread_pool_lock
+    if _thread_pool_lock[0] != os.getpid():
+        _thread_pool_lock = (os.getpid(), threading.Lock())
+    return _thread_pool_lock[1]
+
+
+def _close_thread_pool():
+    "Close the pool of thread_map, if this process made it."
+    global _thread_pool
+    with _get_thread_pool_lock():
+        if _thread_pool is not None and _thread_pool[0] == os.getpid():
+            _thread_pool[2].close()
+        _thread_pool = None
+
+
+atexit.register(_close_thread_pool)
+
+
+def thread_map(func, items, threads):
+    """Apply func to each of items in a pool of threads.
+
+    This only runs faster than a plain map if func releases the GIL, as
+    numba functions compiled with nogil=True do. One pool is kept for later
+    calls; a call with another number of threads replaces it.
+
+    Parameters
+    ----------
+    func : callable
+    items : iterable
+    threads : integer
+        If 1, func is simply mapped in this thread.
+
+    Returns
+    -------
+    list of results, in the order of items
+    """
+    global _thread_pool
+    items = list(items)
+    if threads == 1 or len(items) < 2:
+        return [func(item) for item in items]
+    with _get_thread_pool_lock():
+        # A pool does not survive a fork, e.g. into the workers of batch.
+        pid = os.getpid()
+        if _thread_pool is None or _thread_pool[:2] != (pid, threads):
+            if _thread_pool is not None and _thread_pool[0] == pid:
+                _thread_pool[2].close()  # lets running maps finish
+            _thread_pool = (pid, threads, ThreadPool(threads))
+        # Submit under the lock, so that no other call closes the pool first.
+        result = _thread_pool[2].map_async(func, items)
+    return result.get()
+
+
+class _BoundedFeeder(object):
+    """Feed items to a Pool, keeping at most one item in flight per token.
+
+    Pool.imap consumes its input as fast as it can, which would load a whole
+    movie into memory. Iterating over this object happens in the Pool's
+    task-feeding thread: each item waits there for a free token, which the
+    consumer hands back (task_done) once the corresponding result has been
+    taken off the other end. The token travels along with the item.
+    """
+    def __init__(self, iterable, tokens, prepare=None):
+        self.iterable = iterable
+        self.prepare = prepare
+        self._free = queue.Queue()
+        for token in tokens:
+            self._free.put(token)
+        self._stopped = False
+
+    def __iter__(self):
+        for item in self.iterable:
+            token = self._free.get()
+            if self._stopped:
+                return
+            if self.prepare is not None:
+                item = self.prepare(token, item)
+            yield token, item
+
+    def task_done(self, token):
+        self._free.put(token)
+
+    def stop(self):
+        self._stopped = True
+        self._free.put(None)  # wake up the feeder, if it is waiting
+
+
+def _imap_tokened(func, feeder, processes, initializer=None, initargs=()):
+    "Run func over a _BoundedFeeder in a pool, yielding results in order."
+    pool = multiprocessing.Pool(processes, initializer, initargs)
+    try:
+        for token, result in pool.imap(func, feeder):
+            feeder.task_done(token)
+            yield result
+        pool.close()
+    finally:
+        feeder.stop()
+        pool.terminate()
+        pool.join()
+
+
+class SharedFrameRing(object):
+    """A fixed number of image-sized slots in shared memory.
+
+    The slots are allocated before worker processes are started, so that
+    the workers inherit them: an image copied into a slot by the parent
+    process can be read in place by any worker, without pickling it.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of each image
+    dtype : numpy dtype
+    size : integer
+        Number of slots
+    """
+    def __init__(self, shape, dtype, size):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.buffers = [multiprocessing.RawArray('b', max(nbytes, 1))
+                        for _ in range(size)]
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def fits(self, image):
+        "Whether image can be stored in a slot."
+        return image.shape == self.shape and image.dtype == self.dtype
+
+    def view(self, slot):
+        "An ndarray backed by the memory of the given slot."
+        arr = np.frombuffer(self.buffers[slot], dtype=self.dtype,
+                            count=int(np.prod(self.shape)))
+        return arr.reshape(self.shape)
+
+    def put(self, slot, image):
+        "Copy image into the given slot."
+        self.view(slot)[...] = image
+
+
+_worker_ring = None  # the SharedFrameRing inherited by a worker process
+
+
+def _attach_ring(shape, dtype, buffers, initializer=None, initargs=()):
+    """Pool initializer: make the shared slots available in this worker,
+    then call the initializer of the caller, if any."""
+    global _worker_ring
+    ring = SharedFrameRing.__new__(SharedFrameRing)
+    ring.shape, ring.dtype, ring.buffers = shape, np.dtype(dtype), buffers
+    _worker_ring = ring
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _call_on_slot(func, tokened_message):
+    slot, (frame_no, image) = tokened_message
+    if image is None:
+        image = _worker_ring.view(slot)
+    return slot, func(Frame(image, frame_no=frame_no))
+
+
+def _numbered_frames(frames):
+    "Pair each image with its frame number, or with its position if it has none."
+    for i, image in enumerate(frames):
+        if hasattr(image, 'frame_no') and image.frame_no is not None:
+            yield image.frame_no, image
+        else:
+            yield i, image
+
+
+def imap_frames(func, frames, processes=None, ring_size=None,
+                initializer=None, initargs=()):
+    """Apply func to each image of frames in a pool of worker processes.
+
+    Images are copied once into a ring of shared-memory slots and read in
+    place by the workers; they are not pickled. Results are yielded in the
+    order of the input, and at most ``ring_size`` images are in flight.
+
+    Parameters
+    ----------
+    func : callable
+        Called with one image (a ``pims.Frame`` with its ``frame_no`` set) in
+        a worker process. Must be picklable, i.e. a module-level function or
+        a ``functools.partial`` of one. Keep its return value compact, e.g.
+        arrays instead of DataFrames: it is pickled back to this process.
+        The image is only valid during the call.
+    frames : iterable of images, such as a pims reader
+        Images without a frame number are numbered by their position.
+    processes : integer, 'auto' or None
+        Number of worker processes. If 1, func is simply applied in this
+        process. None or 'auto' (default) uses one process per CPU.
+    ring_size : integer, optional
+        Number of shared-memory slots. Defaults to twice the number of
+        processes.
+    initializer : callable, optional
+        Called with initargs in each worker process when it starts, as in
+        ``multiprocessing.Pool``. Not called if processes is 1.
+    initargs : tuple, optional
+
+    Returns
+    -------
+    generator of results
+
+    Notes
+    -----
+    The slots are sized after the first image. Any later image with another
+    shape or dtype is pickled to its worker as usual.
+    """
+    processes = validate_processes(processes)
+    numbered = _numbered_frames(frames)
+    if processes == 1:
+        for frame_no, image in numbered:
+            yield func(Frame(image, frame_no=frame_no))
+        return
+
+    try:
+        first = next(numbered)
+    except StopIteration:
+        return
+    first_image = np.asarray(first[1])
+    if ring_size is None:
+        ring_size = 2 * processes
+    ring = SharedFrameRing(first_image.shape, first_image.dtype, ring_size)
+
+    def prepare(slot, numbered_image):
+        frame_no, image = numbered_image
+        image = np.asarray(image)
+        if not ring.fits(image):
+            return frame_no, image
+        ring.put(slot, image)
+        return frame_no, None
+
+    feeder = _BoundedFeeder(itertools.chain([first], numbered),
+                            range(ring_size),
+                            prepare)
+    func = functools.partial(_call_on_slot, func)
+    for result in _imap_tokened(func, feeder, processes, _attach_ring,
+                                (ring.shape, ring.dtype.str, ring.buffers,
+                                 initializer, initargs)):
+        yield result
+
@@ -1,17 +1,22 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import six
+import itertools
 import logging
+import warnings
 
 import numpy as np
 from scipy.ndimage.filters import uniform_filter1d, correlate1d
 from scipy.ndimage.fourier import fourier_gaussian
 
-from .utils import validate_tuple
+from .utils import validate_tuple, memo
 from .masks import gaussian_kernel
+from .try_numba import try_numba_autojit, NUMBA_AVAILABLE, NUMBA_NOGIL
+from .parallel import thread_map, validate_threads
 
 
-def bandpass(image, lshort, llong, threshold=None, truncate=4):
+def bandpass(image, lshort, llong, threshold=None, truncate=4,
+             dtype=np.float64, engine='auto', threads=1):
     """Remove noise and background variation.
 
     Convolve with a Gaussian to remove short-wavelength noise and subtract out
@@ -32,6 +37,28 @@ def bandpass(image, lshort, llong, threshold=None, truncate=4):
         when 2*lshort >= llong, no noise filtering is applied
     threshold : float or integer
         By default, 1 for integer images and 1/256. for float images.
+    truncate : number
+        Truncate the Gaussian kernel at this many standard deviations.
+    dtype : {np.float64, np.float32}
+        dtype of the result, and of the intermediate arrays. float32 halves
+        the memory use, which matters most for 3D stacks. The filters
+        themselves still compute in double precision, but the result is
+        rounded to about 7 significant digits: relative to the brightest
+        pixel, the error is around 1e-7, far below the default threshold.
+    engine : {'auto', 'scipy', 'fft', 'numba'}
+        How the Gaussian filter is applied: 'scipy' correlates the image
+        with the (truncated) kernel along each axis, 'fft' multiplies in
+        Fourier space. The latter is faster for large lshort on large
+        images. 'auto' (default) estimates which one is faster for the
+        image shape and kernel size. The boxcar does not depend on these
+        engines: its cost does not grow with llong. 'numba' runs both
+        filters in several threads, and averages unsigned integer images
+        in integer arithmetic; it is only used when asked for. All engines
+        give the same result, up to rounding errors.
+    threads : integer or 'auto'
+        Number of threads of the 'numba' engine. Default is 1. 'auto' uses
+        one thread per CPU. With numba older than 0.18, which cannot release
+        the GIL, one thread is used.
 
     Returns
     -------
@@ -42,27 +69,400 @@ def bandpass(image, lshort, llong, threshold=None, truncate=4):
     --------
     legacy_bandpass, legacy_bandpass_fftw
     """
-    lshort = validate_tuple(lshort, image.ndim)
-    llong = validate_tuple(llong, image.ndim)
+    if engine not in ['auto', 'scipy', 'fft', 'numba']:
+        raise ValueError("Available engines are 'scipy', 'fft' and 'numba'")
+    if engine == 'numba' and not NUMBA_AVAILABLE:
+        warnings.warn("numba could not be imported. Using the 'scipy' "
+                      "engine instead.", UserWarning)
+        engine = 'scipy'
+    lshort, llong, threshold = _validate_bandpass(image.ndim, image.dtype,
+                                                  lshort, llong, threshold)
+    result = np.empty(image.shape, dtype=dtype)
+    boxcar = np.empty(image.shape, dtype=image.dtype)
+    return _bandpass(image, lshort, llong, threshold, truncate, result, boxcar,
+                     engine, validate_threads(threads))
+
+
+def _validate_bandpass(ndim, dtype, lshort, llong, threshold):
+    "Check the bandpass length scales and fill in the default threshold."
+    lshort = validate_tuple(lshort, ndim)
+    llong = validate_tuple(llong, ndim)
     if np.any([x*2 >= y for (x, y) in zip(lshort, llong)]):
         raise ValueError("The smoothing length scale must be more" +
                          "than twice the noise length scale.")
     if threshold is None:
-        if np.issubdtype(image.dtype, np.integer):
+        if np.issubdtype(dtype, np.integer):
             threshold = 1
         else:
             threshold = 1/256.
-    boxcar = image.copy()
-    result = np.array(image, dtype=np.float)
-    for axis, (sigma, smoothing) in enumerate(zip(lshort, llong)):
-        if smoothing > 1:
-            uniform_filter1d(boxcar, 2*smoothing+1, axis, output=boxcar,
-                             mode='nearest', cval=0)
+    return lshort, llong, threshold
+
+
+def _bandpass(image, lshort, llong, threshold, truncate, result, boxcar,
+              engine='auto', threads=1):
+    """Bandpass into preallocated arrays, taking validated parameters.
+
+    result is a float array and boxcar an array of the image's dtype, both
+    of the image's shape. The bandpassed image is written to result, which
+    is returned; boxcar is used as scratch space. See bandpass for the
+    engine and threads."""
+    _bandpass_filters(image, lshort, llong, truncate, result, boxcar, engine,
+                      threads)
+    result -= boxcar
+    below = result > threshold
+    np.logical_not(below, out=below)
+    np.copyto(result, 0, where=below)
+    return result
+
+
+def _bandpass_filters(image, lshort, llong, truncate, result, boxcar,
+                      engine='auto', threads=1, boxcar_engine=None):
+    """Write the Gaussian-filtered image to result and the boxcar-averaged
+    image to boxcar. The first filter of each kind reads from image directly,
+    so that image is not copied into the buffers first. With the 'fft'
+    engine, the Gaussian filter is applied in Fourier space instead.
+    boxcar_engine, if given, overrides engine for the boxcar filter."""
+    if engine == 'numba':
+        _numba_bandpass_filters(image, lshort, llong, truncate, result, boxcar,
+                                threads)
+        return
+    if boxcar_engine is None:
+        boxcar_engine = engine
+    _boxcar_filter(image, llong, boxcar, boxcar_engine, threads)
+    if engine == 'auto':
+        engine = _choose_gaussian_engine(image.shape, lshort, truncate)
+    if engine == 'fft':
+        _fft_gaussian(image, lshort, truncate, result)
+        return
+    source = image
+    for axis, sigma in enumerate(lshort):
         if sigma > 0:
-            correlate1d(result, gaussian_kernel(sigma, truncate), axis,
+            correlate1d(source, gaussian_kernel(sigma, truncate), axis,
                         output=result, mode='constant', cval=0.0)
+            source = result
+    if source is image:
+        result[...] = image
+
+
+def _numba_bandpass_filters(image, lshort, llong, truncate, result, boxcar,
+                            threads):
+    """The same as _bandpass_filters, with numba kernels that release the GIL,
+    running in a pool of threads."""
+    image = np.ascontiguousarray(image)
+    _boxcar_filter(image, llong, boxcar, 'numba', threads)
+    source = image
+    for axis, sigma in enumerate(lshort):
+        if sigma > 0:
+            _map_lines(_numba_correlate_lines, source,
+                       gaussian_kernel(sigma, truncate), result, axis,
+                       threads)
+            source = result
+    if source is image:
+        result[...] = image
+
+
+def _boxcar_filter(image, llong, boxcar, engine, threads):
+    """Write the boxcar average of image to boxcar, as uniform_filter1d does.
+
+    With the 'numba' engine, the running sums of unsigned integer images
+    are done in integer arithmetic, without converting to floats. This gives
+    the exact average, truncated to an integer. uniform_filter1d computes a
+    running mean in floating point instead, so that the two can differ by
+    one where the average is (almost) an integer."""
+    if engine != 'numba' or not NUMBA_AVAILABLE:
+        kernel = None
+    elif image.dtype.kind == 'u':
+        image = np.ascontiguousarray(image)
+        kernel = _numba_boxcar_lines_integer
+    else:
+        kernel = _numba_boxcar_lines
+    source = image
+    for axis, smoothing in enumerate(llong):
+        if smoothing > 1:
+            if kernel is None:
+                uniform_filter1d(source, 2*smoothing+1, axis, output=boxcar,
+                                 mode='nearest', cval=0)
+            else:
+                _map_lines(kernel, source, 2*smoothing+1, boxcar, axis,
+                           threads)
+            source = boxcar
+    if source is image:
+        boxcar[...] = image
+
+
+_LINE_BLOCK = 256  # the number of lines along an axis that a kernel filters
+
+
+def _map_lines(kernel, source, arg, output, axis, threads):
+    """Filter source along axis into output with kernel, in blocks of lines
+    distributed over threads. Both arrays must be C-contiguous.
+
+    The arrays are viewed as (outer, length, inner), with the axis in the
+    middle, so that the lines are contiguous along the inner dimension. The
+    work is split along the outer dimension, and into blocks of the inner
+    one. The kernels only release the GIL with numba 0.18 or later; with
+    older numba, one thread is used."""
+    if not NUMBA_NOGIL:
+        threads = 1
+    shape = source.shape
+    outer = int(np.prod(shape[:axis], dtype=np.int64))
+    inner = int(np.prod(shape[axis + 1:], dtype=np.int64))
+    source = source.reshape(outer, shape[axis], inner)
+    output = output.reshape(outer, shape[axis], inner)
+    inner_bounds = [(start, min(start + _LINE_BLOCK, inner))
+                    for start in range(0, inner, _LINE_BLOCK)]
+    # Aim for a few work items per thread, to even out their load.
+    outer_chunks = -(-4 * threads // len(inner_bounds))  # ceil
+    outer_step = -(-outer // outer_chunks)
+
+    def work(bounds):
+        (outer_start, (inner_start, inner_stop)) = bounds
+        outer_stop = min(outer_start + outer_step, outer)
+        kernel(source[outer_start:outer_stop], arg,
+               output[outer_start:outer_stop], inner_start, inner_stop)
+
+    thread_map(work, itertools.product(range(0, outer, outer_step),
+                                       inner_bounds), threads)
+
+
+@try_numba_autojit(nopython=True, nogil=NUMBA_NOGIL)
+def _numba_correlate_lines(source, kernel, output, start, stop):
+    # correlate1d(mode='constant', cval=0) along axis 1 of the 3D arrays
+    # source and output, for the lines start:stop along axis 2. source and
+    # output may be the same array.
+    N_outer, length = source.shape[0], source.shape[1]
+    width = stop - start
+    lw = kernel.shape[0] // 2
+    padded = np.zeros((length + 2 * lw, width))
+    total = np.empty(width)
+    for o in range(N_outer):
+        for i in range(length):
+            for j in range(width):
+                padded[i + lw, j] = source[o, i, start + j]
+        for i in range(length):
+            for j in range(width):
+                total[j] = 0.
+            for k in range(kernel.shape[0]):
+                weight = kernel[k]
+                for j in range(width):
+                    total[j] += weight * padded[i + k, j]
+            for j in range(width):
+                output[o, i, start + j] = total[j]
+
+
+@try_numba_autojit(nopython=True, nogil=NUMBA_NOGIL)
+def _numba_boxcar_lines(source, size, output, start, stop):
+    # uniform_filter1d(size, mode='nearest') along axis 1 of the 3D arrays
+    # source and output, for the lines start:stop along axis 2, as a running
+    # sum. The output agrees with scipy's up to rounding errors.
+    N_outer, length = source.shape[0], source.shape[1]
+    width = stop - start
+    before = size // 2
+    padded = np.empty((length + size - 1, width))
+    total = np.empty(width)
+    for o in range(N_outer):
+        for i in range(length + size - 1):
+            i_source = min(max(i - before, 0), length - 1)
+            for j in range(width):
+                padded[i, j] = source[o, i_source, start + j]
+        for j in range(width):
+            total[j] = 0.
+        for i in range(size):
+            for j in range(width):
+                total[j] += padded[i, j]
+        for j in range(width):
+            output[o, 0, start + j] = total[j] / size
+        for i in range(1, length):
+            for j in range(width):
+                total[j] += padded[i + size - 1, j] - padded[i - 1, j]
+                output[o, i, start + j] = total[j] / size
+
+
+@try_numba_autojit(nopython=True, nogil=NUMBA_NOGIL)
+def _numba_boxcar_lines_integer(source, size, output, start, stop):
+    # The same as _numba_boxcar_lines, for unsigned integer arrays: the
+    # running sum is an integer, and the average is rounded down.
+    N_outer, length = source.shape[0], source.shape[1]
+    width = stop - start
+    before = size // 2
+    after = size - before - 1
+    lines = np.empty((length, width), dtype=np.int64)  # source may be output
+    total = np.empty(width, dtype=np.int64)
+    for o in range(N_outer):
+        for i in range(length):
+            for j in range(width):
+                lines[i, j] = source[o, i, start + j]
+        for j in range(width):
+            total[j] = 0
+        for i in range(-before, after + 1):
+            i_source = min(max(i, 0), length - 1)
+            for j in range(width):
+                total[j] += lines[i_source, j]
+        for j in range(width):
+            output[o, 0, start + j] = total[j] // size
+        for i in range(1, length):
+            i_add = min(i + after, length - 1)
+            i_remove = max(i - before - 1, 0)
+            for j in range(width):
+                total[j] += lines[i_add, j] - lines[i_remove, j]
+                output[o, i, start + j] = total[j] // size
+
+
+def _fft_size(n):
+    "The smallest integer >= n without prime factors other than 2, 3 and 5."
+    best = 2 ** int(np.ceil(np.log2(n)))
+    power5 = 1
+    while power5 < best:
+        power35 = power5
+        while power35 < best:
+            size = power35
+            while size < n:
+                size *= 2
+            best = min(best, size)
+            power35 *= 3
+        power5 *= 5
+    return best
+
+
+@memo
+def _gaussian_transfer(size, sigma, truncate, half):
+    """The discrete Fourier transform of gaussian_kernel(sigma, truncate),
+    centered on index 0 of a signal of the given size. As the kernel is
+    symmetric, it is real. If half, only the part computed by rfft."""
+    kernel = gaussian_kernel(sigma, truncate)
+    lw = len(kernel) // 2
+    padded = np.zeros(size)
+    padded[:lw + 1] = kernel[lw:]
+    if lw > 0:
+        padded[-lw:] = kernel[:lw]
+    if half:
+        return np.fft.rfft(padded).real
+    return np.fft.fft(padded).real
+
+
+def _fft_gaussian(image, lshort, truncate, result):
+    """Write the Gaussian-filtered image to result, as the separable
+    correlate1d calls in _bandpass_filters would (mode='constant'), but by
+    multiplication in Fourier space. The transfer functions are cached, so
+    that only the transforms of the image are computed for every frame.
+    pyfftw is used if it is available; it caches its FFT plans."""
+    ndim = image.ndim
+    widths = [int(truncate * sigma + 0.5) if sigma > 0 else 0
+              for sigma in lshort]
+    # Zero-padding by the kernel width keeps the circular convolution from
+    # wrapping around.
+    fshape = [_fft_size(n + w) for (n, w) in zip(image.shape, widths)]
+    if FFTW_AVAILABLE:
+        rfftn = pyfftw.interfaces.numpy_fft.rfftn
+        irfftn = pyfftw.interfaces.numpy_fft.irfftn
+    else:
+        rfftn, irfftn = np.fft.rfftn, np.fft.irfftn
+    spectrum = rfftn(image, fshape)
+    for axis, sigma in enumerate(lshort):
+        if sigma <= 0:
+            continue
+        transfer = _gaussian_transfer(fshape[axis], float(sigma),
+                                      float(truncate), axis == ndim - 1)
+        index = [np.newaxis] * ndim
+        index[axis] = slice(None)
+        spectrum *= transfer[tuple(index)]
+    filtered = irfftn(spectrum, fshape)
+    result[...] = filtered[tuple([slice(0, n) for n in image.shape])]
+
+
+def _choose_gaussian_engine(shape, lshort, truncate):
+    """'fft' if filtering in Fourier space is expected to be faster than the
+    separable spatial filter, 'scipy' otherwise."""
+    # Estimated time per pixel, in units of one multiply-add of the spatial
+    # filter: a correlate1d pass costs _FILTER_PASS_COST plus the kernel
+    # width, the FFT _FFT_COST per dimension and per log2 of the padded size.
+    # See the constants below for where they come from. The FFT rarely wins
+    # in 3D, because of the zero-padding.
+    widths = [int(truncate * sigma + 0.5) for sigma in lshort]
+    spatial_cost = sum([_FILTER_PASS_COST + 2 * w + 1
+                        for (sigma, w) in zip(lshort, widths) if sigma > 0])
+    fshape = [_fft_size(n + w) for (n, w) in zip(shape, widths)]
+    fft_size = np.prod(fshape, dtype=np.float64)
+    fft_cost = (_FFT_COST * len(shape) * np.log2(fft_size) *
+                fft_size / np.prod(shape, dtype=np.float64))
+    if fft_cost < spatial_cost:
+        return 'fft'
+    return 'scipy'
+
+
+# The constants were fitted to the time bandpass takes with either engine
+# (scipy and numpy.fft, float64) on 2048x2048 images with lshort from 2 to
+# 16, and on 64x256x256 stacks. On 2048x2048 images, the FFT becomes faster
+# from lshort of about 12 to 16. The constants differ between machines and
+# FFT libraries, so 'auto' is a rough guide only. It does not matter much
+# near the break-even point, where both engines take about as long.
+_FILTER_PASS_COST = 47  # overhead of one correlate1d pass
+_FFT_COST = 7  # per dimension, per log2(size), per padded pixel
+
+
+def _bandpass_to_gamut(image, lshort, llong, threshold, truncate, result,
+                       boxcar, scaled, engine='auto', threads=1):
+    """Bandpass, and rescale the result to fill the range of the integer
+    array scaled, as scale_to_gamut does. Returns the scale factor.
+
+    result and boxcar are as in _bandpass; result is overwritten. With
+    numba, the subtraction, the threshold and the rescaling take two passes
+    over the buffers, and no temporary arrays. With more than one thread
+    (and numba >= 0.18), the filters are those of the numba bandpass engine. The Gaussian filter
+    is never applied in Fourier space here: its small rounding differences
+    could change which pixels are local maxima after the rescaling."""
+    use_numba = engine != 'python' and NUMBA_AVAILABLE
+    if use_numba and threads > 1 and NUMBA_NOGIL:
+        filter_engine = 'numba'
+    else:
+        filter_engine = 'scipy'
+    _bandpass_filters(image, lshort, llong, truncate, result, boxcar,
+                      filter_engine, threads,
+                      boxcar_engine='numba' if use_numba else 'scipy')
+    if use_numba:
+        flat_result = result.reshape(-1)
+        maximum = _numba_subtract_threshold(flat_result, boxcar.reshape(-1),
+                                            threshold)
+        scale_factor = scalefactor_to_gamut(np.float64(maximum), scaled.dtype)
+        _numba_scale(flat_result, scale_factor, scaled.reshape(-1))
+        return scale_factor
+
     result -= boxcar
-    return np.where(result > threshold, result, 0)
+    below = result > threshold
+    np.logical_not(below, out=below)
+    np.copyto(result, 0, where=below)
+    scale_factor = scalefactor_to_gamut(result, scaled.dtype)
+    np.maximum(result, 0., out=result)
+    result *= scale_factor
+    np.copyto(scaled, result, casting='unsafe')
+    return scale_factor
+
+
+@try_numba_autojit(nopython=True)
+def _numba_subtract_threshold(result, boxcar, threshold):
+    # Subtract boxcar from result and set values not above threshold to
+    # zero, in place. Returns the maximum. Both arrays are flat.
+    maximum = -np.inf
+    for i in range(result.shape[0]):
+        value = result[i] - boxcar[i]
+        if not value > threshold:
+            value = 0.
+        result[i] = value
+        if value > maximum:
+            maximum = value
+    return maximum
+
+
+@try_numba_autojit(nopython=True)
+def _numba_scale(result, scale_factor, scaled):
+    # scaled = (scale_factor * result.clip(min=0)) cast to the integer dtype
+    # of scaled. Both arrays are flat.
+    for i in range(result.shape[0]):
+        value = result[i]
+        if value > 0:
+            scaled[i] = value * scale_factor
+        else:
+            scaled[i] = 0
 
 
 # Below are two older implementations of bandpass. Formerly, they were lumped
@@ -3,15 +3,17 @@ from __future__ import (absolute_import, division, print_function,
 import six
 from six.moves import range
 import os
+import pickle
 import unittest
 import warnings
+from multiprocessing.pool import ThreadPool
 
 import nose
 import numpy as np
 import pandas as pd
 from pandas import DataFrame, Series
 from numpy.testing import (assert_almost_equal, assert_allclose,
-                           assert_array_less)
+                           assert_array_less, assert_equal)
 from numpy.testing.decorators import slow
 from pandas.util.testing import (assert_series_equal, assert_frame_equal,
                                  assert_produces_warning)
@@ -21,7 +23,9 @@ from trackpy.try_numba import NUMBA_AVAILABLE
 from trackpy.artificial import (draw_feature, draw_spots, draw_point,
                                 gen_nonoverlapping_locations)
 from trackpy.utils import pandas_sort
+from pims import Frame
                                 
+from scipy import ndimage
 from scipy.spatial import cKDTree
 
 # Catch attempts to set values on an inadvertent copy of a Pandas object.
@@ -765,6 +769,523 @@ class CommonFeatureIdentificationTests(object):
         assert np.isnan(np.asscalar(actual.ep))
 
 
+class TestPrefilter(unittest.TestCase):
+    def test_estimate_mass_size(self):
+        for shape, radius in [((40, 51), (3, 3)), ((40, 51), (2, 4)),
+                              ((15, 20, 21), (2, 3, 3))]:
+            image = np.random.randint(0, 255, shape).astype(np.uint8)
+            coords = np.array([np.random.randint(r, s - r, 30)
+                               for r, s in zip(radius, shape)]).T
+            mass, size = tp.feature._estimate_mass_size(image, radius, coords)
+            for i, coord in enumerate(coords):
+                expected_mass = tp.estimate_mass(image, radius, coord)
+                self.assertEqual(mass[i], expected_mass)
+                self.assertEqual(size[i], tp.estimate_size(image, radius, coord,
+                                                           expected_mass))
+
+
+class TestPercentileThreshold(unittest.TestCase):
+    def test_histogram(self):
+        # Integer images take the histogram path: compare with np.percentile.
+        np.random.seed(0)
+        for dtype in [np.uint8, np.uint16]:
+            for fraction in [0.01, 0.5, 1]:
+                image = np.random.randint(0, np.iinfo(dtype).max, (50, 60))
+                image[np.random.random(image.shape) > fraction] = 0
+                image = image.astype(dtype)
+                not_black = image[image != 0]
+                for percentile in [0, 20, 64, 99.9, 100]:
+                    actual = tp.percentile_threshold(image, percentile)
+                    expected = np.percentile(not_black, percentile)
+                    assert_allclose(actual, expected)
+
+    def test_black(self):
+        for dtype in [np.uint8, np.uint16, np.float64]:
+            image = np.zeros((10, 10), dtype=dtype)
+            self.assertTrue(np.isnan(tp.percentile_threshold(image, 64)))
+
+
+class TestLocalMaxima(unittest.TestCase):
+    def reference(self, image, radius, percentile, margin):
+        # The definition: pixels equal to their grey dilation.
+        threshold = tp.percentile_threshold(image, percentile)
+        footprint = tp.masks.binary_mask(radius, image.ndim)
+        dilation = ndimage.grey_dilation(image, footprint=footprint,
+                                         mode='constant')
+        maxima = np.argwhere((image == dilation) & (image > threshold))
+        shape = np.array(image.shape)
+        near_edge = np.any((maxima < margin) |
+                           (maxima > (shape - margin - 1)), 1)
+        return maxima[~near_edge]
+
+    def check_engine(self, engine):
+        np.random.seed(0)
+        for shape, radius, dtype, offset in [
+                ((60, 51), 3, np.uint8, 0), ((60, 51), (2, 5), np.uint8, 0),
+                ((15, 20, 21), (2, 3, 3), np.uint16, 0),
+                ((80, 70), 7, np.int16, -300)]:
+            image = np.random.randint(0, 255, shape).astype(float)
+            image = ndimage.gaussian_filter(image, 1.5) * 3 + offset
+            image = image.astype(dtype)
+            for margin in [0, 2, 4]:
+                expected = self.reference(image, radius, 20, margin)
+                actual = tp.local_maxima(image, radius, 20, margin,
+                                         engine=engine)
+                assert_equal(actual, expected)
+
+    def test_python(self):
+        self.check_engine('python')
+
+    def test_numba(self):
+        if not NUMBA_AVAILABLE:
+            raise nose.SkipTest("Numba not installed. Skipping.")
+        self.check_engine('numba')
+
+    def test_many_maxima(self):
+        # More maxima than the initial buffer of the numba engine holds.
+        np.random.seed(0)
+        image = np.random.randint(0, 255, (200, 190)).astype(np.uint8)
+        expected = self.reference(image, 1, 20, 1)
+        self.assertGreater(len(expected), 1024)
+        for engine in ['python', 'numba']:
+            if engine == 'numba' and not NUMBA_AVAILABLE:
+                continue
+            assert_equal(tp.local_maxima(image, 1, 20, 1, engine=engine),
+                         expected)
+
+
+class TestEliminateDuplicates(unittest.TestCase):
+    def test_chain(self):
+        # B is a duplicate of A, C of B: both are dropped in the first round,
+        # although C is not close to A.
+        results = np.array([[10., 0., 3.], [15., 0., 2.], [20., 0., 1.]])
+        actual = tp.feature._eliminate_duplicates(results, (6, 6), 2)
+        assert_equal(actual, results[:1])
+
+    def test_tie(self):
+        # Equal mass: drop the one with the smaller sum of coordinates.
+        results = np.array([[10., 1., 1.], [10., 0., 1.], [30., 0., 1.]])
+        actual = tp.feature._eliminate_duplicates(results, (6, 6), 2)
+        assert_equal(actual, results[[0, 2]])
+
+
+class TestRefineThreads(unittest.TestCase):
+    def test_identical(self):
+        # Splitting the features over threads must not change the results.
+        if not NUMBA_AVAILABLE:
+            raise nose.SkipTest("Numba not installed. Skipping.")
+        np.random.seed(0)
+        for shape, radius in [((300, 310), 4), ((300, 310), (3, 5)),
+                              ((30, 64, 70), 3), ((30, 64, 70), (2, 3, 3))]:
+            pos = gen_nonoverlapping_locations(shape, 200, 10, 8)
+            image = draw_spots(shape, pos, 7, noise_level=10)
+            coords = np.round(pos).astype(int)
+            for characterize in [True, False]:
+                expected = tp.refine(image, image, radius, coords,
+                                     engine='numba',
+                                     characterize=characterize)
+                actual = tp.refine(image, image, radius, coords,
+                                   engine='numba', characterize=characterize,
+                                   threads=3)
+                assert_equal(actual, expected)
+
+    def test_without_nogil(self):
+        # Numba < 0.18 cannot release the GIL: refine uses one thread.
+        if not NUMBA_AVAILABLE:
+            raise nose.SkipTest("Numba not installed. Skipping.")
+        pos = gen_nonoverlapping_locations((300, 310), 200, 10, 8)
+        image = draw_spots((300, 310), pos, 7, noise_level=10)
+        coords = np.round(pos).astype(int)
+        expected = tp.refine(image, image, 4, coords, engine='numba')
+
+        used_threads = []
+
+        def thread_map(func, items, threads):
+            used_threads.append(threads)
+            return orig_thread_map(func, items, threads)
+
+        orig_thread_map = tp.feature.thread_map
+        orig_nogil = tp.feature.NUMBA_NOGIL
+        tp.feature.thread_map = thread_map
+        tp.feature.NUMBA_NOGIL = False
+        try:
+            actual = tp.refine(image, image, 4, coords, engine='numba',
+                               threads=3)
+        finally:
+            tp.feature.thread_map = orig_thread_map
+            tp.feature.NUMBA_NOGIL = orig_nogil
+        assert_equal(actual, expected)
+        self.assertEqual(used_threads, [1])
+
+    def test_locate(self):
+        pos = gen_nonoverlapping_locations((200, 210), 40, 15, 10)
+        image = draw_spots((200, 210), pos, 9, noise_level=10)
+        expected = tp.locate(image, 9, minmass=1000)
+        actual = tp.locate(image, 9, minmass=1000, threads=2)
+        assert_allclose(actual.values, expected.values)
+
+
+class TestSelectiveCharacterize(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.pos = gen_nonoverlapping_locations((200, 210), 40, 15, 10)
+        self.image = draw_spots((200, 210), self.pos, 9, noise_level=10)
+
+    def test_refine(self):
+        coords = np.round(self.pos).astype(int)
+        engines = ['python', 'numba'] if NUMBA_AVAILABLE else ['python']
+        # The columns of the full results are x, y, mass, size (one per
+        # axis if anisotropic), ecc, signal and raw_mass.
+        cases = [(4, ['ecc'], [4]), (4, ['raw_mass', 'size'], [3, 6]),
+                 ((3, 4), ['ecc'], [5]),
+                 ((3, 4), ['raw_mass', 'size'], [3, 4, 7])]
+        for engine in engines:
+            for radius, quantities, columns in cases:
+                full = tp.refine(self.image, self.image, radius, coords,
+                                 engine=engine)
+                actual = tp.refine(self.image, self.image, radius, coords,
+                                   engine=engine, characterize=quantities)
+                assert_equal(actual, full[:, [0, 1, 2] + columns])
+
+    def test_locate(self):
+        full = tp.locate(self.image, 9, minmass=1000)
+        for quantities in [['size'], ['signal', 'ep'], 'ecc', []]:
+            actual = tp.locate(self.image, 9, minmass=1000,
+                               characterize=quantities)
+            columns = ['x', 'y', 'mass'] + [c for c in full.columns
+                                            if c in quantities]
+            assert_frame_equal(actual, full[columns])
+
+    def test_maxsize(self):
+        # Filtering by size works without returning the size.
+        expected = tp.locate(self.image, 9, minmass=1000, maxsize=2.5)
+        actual = tp.locate(self.image, 9, minmass=1000, maxsize=2.5,
+                           characterize=['ecc'])
+        assert_frame_equal(actual, expected[['x', 'y', 'mass', 'ecc']])
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, tp.locate, self.image, 9,
+                          characterize=['size', 'colour'])
+        self.assertRaises(ValueError, tp.refine, self.image, self.image, 4,
+                          [[100, 100]], characterize=['ep'])
+
+
+class TestRefineBatch(unittest.TestCase):
+    def setUp(self):
+        if not NUMBA_AVAILABLE:
+            raise nose.SkipTest("Numba not installed. Skipping.")
+
+    def test_frame_by_frame(self):
+        # The same as refine on each frame, duplicates eliminated per frame.
+        np.random.seed(0)
+        shape, radius = (64, 70), 4
+        frames, coords = [], []
+        for count in [20, 0, 35, 1]:
+            pos = np.empty((0, 2))
+            if count > 0:
+                pos = gen_nonoverlapping_locations(shape, count, 10, 8)
+            frames.append(draw_spots(shape, pos, 7, noise_level=10))
+            coords.append(np.round(pos).reshape(-1, 2))
+        coords[2][1] = coords[2][0]  # a duplicate
+        offsets = np.cumsum([0] + [len(c) for c in coords])
+        for characterize in [True, False]:
+            expected = [tp.refine(f, f, radius, c, separation=3,
+                                  engine='numba', characterize=characterize)
+                        for f, c in zip(frames, coords)]
+            for threads in [1, 2]:
+                results, new_offsets = tp.refine_batch(
+                    frames, frames, radius, np.concatenate(coords), offsets,
+                    separation=3, characterize=characterize, threads=threads)
+                assert_equal(new_offsets,
+                             np.cumsum([0] + [len(e) for e in expected]))
+                assert_allclose(results, np.concatenate(expected))
+
+    def test_offsets(self):
+        frames = np.zeros((2, 20, 20))
+        self.assertRaises(ValueError, tp.refine_batch, frames, frames, 3,
+                          np.full((3, 2), 10.), [0, 3])
+        self.assertRaises(ValueError, tp.refine_batch, frames, frames, 3,
+                          np.full((3, 2), 10.), [0, 2, 1])
+
+
+class TestRefineND(unittest.TestCase):
+    def setUp(self):
+        if not NUMBA_AVAILABLE:
+            raise nose.SkipTest("Numba not installed. Skipping.")
+
+    def test_generic_kernel(self):
+        # The N-dimensional kernel must reproduce the 2D and 3D ones.
+        np.random.seed(0)
+        for shape, radius in [((300, 310), (4, 4)), ((300, 310), (3, 5)),
+                              ((30, 64, 70), (3, 3, 3)),
+                              ((30, 64, 70), (2, 3, 3))]:
+            pos = gen_nonoverlapping_locations(shape, 200, 10, 8)
+            image = draw_spots(shape, pos, 7, noise_level=10)
+            coords = np.round(pos)
+            isotropic = radius[1:] == radius[:-1]
+            for quantities in [('size', 'ecc', 'signal', 'raw_mass'), (),
+                               ('ecc', 'raw_mass'), ('size',)]:
+                # The columns of the other quantities are not computed.
+                wanted = tp.feature._refine_columns(quantities, len(shape),
+                                                    isotropic)
+                results = []
+                for generic in [False, True]:
+                    kernel, head, tail, columns = \
+                        tp.feature._numba_refine_setup(
+                            image, image, radius, 10, 0.6, 0.005,
+                            quantities, generic)
+                    result = np.empty((len(coords), columns))
+                    kernel(*(head + (coords, len(coords)) + tail +
+                             (result,)))
+                    results.append(result[:, wanted])
+                assert_equal(results[1], results[0])
+
+    def test_4D(self):
+        np.random.seed(0)
+        shape = (16, 18, 20, 22)
+        pos = np.array([[5., 6.3, 7., 8.], [10.2, 12., 8.5, 14.],
+                        [7., 12.6, 14., 6.2], [11., 6., 13., 16.7]])
+        image = draw_spots(shape, pos, 5, noise_level=5)
+        for characterize in [True, False]:
+            expected = tp.locate(image, 5, minmass=200, engine='python',
+                                 characterize=characterize)
+            actual = tp.locate(image, 5, minmass=200, engine='numba',
+                               characterize=characterize)
+            self.assertEqual(len(actual), len(pos))
+            # The python engine interpolates below one pixel, numba does not.
+            assert_allclose(actual.values, expected.values, rtol=0.1,
+                            atol=0.1)
+
+    def test_auto_without_nogil(self):
+        # On numba < 0.18, 'auto' refines 4D images in python.
+        shape = (16, 18, 20, 22)
+        pos = np.array([[5., 6.3, 7., 8.], [10.2, 12., 8.5, 14.]])
+        image = draw_spots(shape, pos, 5, noise_level=5)
+        coords = np.round(pos).astype(int)
+        expected = tp.refine(image, image, 5, coords, engine='python')
+
+        def fail(*args):
+            raise AssertionError("The numba engine was used.")
+
+        kernel = tp.feature._numba_refine_ND
+        orig_nogil = tp.feature.NUMBA_NOGIL
+        tp.feature._numba_refine_ND = fail
+        tp.feature.NUMBA_NOGIL = False
+        try:
+            actual = tp.refine(image, image, 5, coords)
+        finally:
+            tp.feature._numba_refine_ND = kernel
+            tp.feature.NUMBA_NOGIL = orig_nogil
+        assert_equal(actual, expected)
+
+
+class TestMeasureNoise(unittest.TestCase):
+    def test_background(self):
+        if not NUMBA_AVAILABLE:
+            raise nose.SkipTest("Numba not installed. Skipping.")
+        np.random.seed(0)
+        for shape, radius in [((50, 60), 3), ((50, 60), (2, 5)),
+                              ((20, 30, 25), (1, 4, 2)), ((100,), 3),
+                              ((7, 9), 5)]:
+            structure = tp.masks.binary_mask(radius, len(shape))
+            for fraction in [0.001, 0.05, 0.5]:
+                image = (np.random.random(shape) < fraction).astype(np.uint8)
+                expected = ~ndimage.binary_dilation(image, structure)
+                actual = tp.uncertainty._background(image, structure)
+                assert_equal(actual, expected)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.shape = (128, 111)
+        self.frames = []
+        for i in range(4):
+            pos = gen_nonoverlapping_locations(self.shape, 10, separation=20,
+                                               margin=10)
+            self.frames.append(draw_spots(self.shape, pos, 15,
+                                          noise_level=10))
+        self.expected = tp.batch(self.frames, 9, minmass=1000)
+
+    def test_frame_numbers(self):
+        assert_allclose(self.expected['frame'].unique(), np.arange(4))
+
+    def test_processes(self):
+        actual = tp.batch(self.frames, 9, minmass=1000, processes=2)
+        assert_frame_equal(actual, self.expected)
+        actual = tp.batch(iter(self.frames), 9, minmass=1000,
+                          processes='auto')
+        assert_frame_equal(actual, self.expected)
+
+    def test_threads(self):
+        # Concurrent batches do not share their working arrays.
+        pool = ThreadPool(4)
+        try:
+            results = pool.map(
+                lambda frames: tp.batch(frames, 9, minmass=1000),
+                [self.frames] * 8)
+        finally:
+            pool.close()
+        for actual in results:
+            assert_frame_equal(actual, self.expected)
+        self.assertIsNone(tp.feature._worker_plans)
+
+    def test_locate_each_frame(self):
+        expected = pd.concat([tp.locate(Frame(f, frame_no=i), 9, minmass=1000)
+                              for i, f in enumerate(self.frames)])
+        assert_frame_equal(self.expected, expected.reset_index(drop=True))
+
+    def test_as_array(self):
+        actual = tp.batch(self.frames, 9, minmass=1000, as_array=True)
+        self.assertIsInstance(actual, np.ndarray)
+        self.assertEqual(list(actual.dtype.names),
+                         list(self.expected.columns))
+        for c in self.expected.columns:
+            assert_allclose(actual[c], self.expected[c])
+        self.assertEqual(actual['frame'].dtype, np.int64)
+
+    def test_accumulator(self):
+        accumulator = tp.feature._FeatureAccumulator(['x', 'y'], capacity=1)
+        for i in range(3):
+            accumulator.append(np.full((i + 1, 2), i, dtype=float), i)
+        actual = accumulator.to_dataframe()
+        assert_allclose(actual['x'], [0, 1, 1, 2, 2, 2])
+        assert_allclose(actual['frame'], [0, 1, 1, 2, 2, 2])
+
+    def test_locate_as_array(self):
+        frame = Frame(self.frames[1], frame_no=7)
+        expected = tp.locate(frame, 9, minmass=1000)
+        actual = tp.locate(frame, 9, minmass=1000, as_array=True)
+        self.assertEqual(list(actual.dtype.names), list(expected.columns))
+        assert_allclose(actual['x'], expected['x'])
+        assert_allclose(actual['frame'], 7)
+
+    def test_batch_iter(self):
+        actual = list(tp.batch_iter(self.frames, 9, minmass=1000))
+        self.assertEqual(len(actual), 4)
+        assert_frame_equal(pd.concat(actual).reset_index(drop=True),
+                           self.expected)
+
+    def test_batch_iter_link(self):
+        features = tp.batch_iter(iter(self.frames), 9, minmass=1000)
+        actual = pd.concat(tp.link_df_iter(features, 5))
+        expected = tp.link_df(self.expected, 5)
+        columns = ['frame', 'x', 'y', 'particle']
+        assert_allclose(pandas_sort(actual, columns)[columns].values,
+                        pandas_sort(expected, columns)[columns].values)
+
+    def test_no_features(self):
+        frames = [np.zeros(self.shape, dtype=np.uint8)] * 2
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.assertEqual(len(tp.batch(frames, 9)), 0)
+            self.assertEqual(list(tp.batch_iter(frames, 9)), [])
+
+
+class TestLocatePlan(unittest.TestCase):
+    def setUp(self):
+        self.shape = (128, 111)
+        self.frames = []
+        for i in range(3):
+            pos = gen_nonoverlapping_locations(self.shape, 10, separation=20,
+                                               margin=10)
+            self.frames.append(draw_spots(self.shape, pos, 15,
+                                          noise_level=10))
+
+    def check_plan(self, frames, **kwargs):
+        plan = tp.LocatePlan(frames[0].shape, frames[0].dtype, 9, **kwargs)
+        for frame in frames:
+            assert_frame_equal(plan(frame), tp.locate(frame, 9, **kwargs))
+
+    def test_plan(self):
+        self.check_plan(self.frames, minmass=1000)
+        self.check_plan(self.frames, minmass=1000, topn=5, characterize=False)
+
+    def test_invert(self):
+        frames = [255 - frame for frame in self.frames]
+        self.check_plan(frames, minmass=1000, invert=True)
+
+    def test_float(self):
+        frames = [frame / 255. for frame in self.frames]
+        self.check_plan(frames, minmass=5)
+        self.check_plan(frames, minmass=5, preprocess=False)
+
+    def test_float32(self):
+        for frame in self.frames:
+            expected = tp.locate(frame, 9, minmass=1000)
+            actual = tp.locate(frame, 9, minmass=1000, float_dtype=np.float32)
+            assert_allclose(actual.values, expected.values, rtol=1e-3)
+
+    def test_wrong_shape(self):
+        plan = tp.LocatePlan(self.shape, np.uint8, 9)
+        self.assertRaises(ValueError, plan, self.frames[0][:-1])
+        self.assertRaises(ValueError, plan, self.frames[0].astype(np.uint16))
+
+    def test_pickle(self):
+        plan = tp.LocatePlan(self.shape, self.frames[0].dtype, 9,
+                             minmass=1000)
+        expected = plan(self.frames[0])
+        unpickled = pickle.loads(pickle.dumps(plan))
+        self.assertIsNone(unpickled._buffers)
+        assert_frame_equal(unpickled(self.frames[0]), expected)
+
+
+class TestLocateTiled(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.shape = (300, 260)
+        pos = gen_nonoverlapping_locations(self.shape, 60, separation=20,
+                                           margin=10)
+        self.image = draw_spots(self.shape, pos, 15, noise_level=10)
+        self.expected = self.sort(tp.locate(self.image, 9, minmass=1000))
+
+    def sort(self, f):
+        return pandas_sort(f, ['x', 'y']).reset_index(drop=True)
+
+    def test_whole_image(self):
+        # Rescaling per tile changes mass and signal slightly.
+        actual = self.sort(tp.locate_tiled(self.image, 9, 100, minmass=1000))
+        self.assertEqual(len(actual), len(self.expected))
+        assert_allclose(actual[['x', 'y', 'size', 'ecc', 'raw_mass']],
+                        self.expected[['x', 'y', 'size', 'ecc', 'raw_mass']],
+                        atol=0.01)
+        assert_allclose(actual['mass'], self.expected['mass'], rtol=0.01)
+
+    def test_processes(self):
+        expected = tp.locate_tiled(self.image, 9, (64, 128), minmass=1000)
+        actual = tp.locate_tiled(self.image, 9, (64, 128), minmass=1000,
+                                 processes=2)
+        assert_frame_equal(actual, expected)
+
+    def test_plan_per_tile_shape(self):
+        # Tiles near the edges of a 3D image have many different shapes.
+        # Each shape gets one plan.
+        image = np.random.randint(0, 100, (50, 50, 50)).astype(np.uint8)
+        shapes = []
+        plan_class = tp.feature.LocatePlan
+
+        def make_plan(shape, *args, **kwargs):
+            shapes.append(tuple(shape))
+            return plan_class(shape, *args, **kwargs)
+
+        tp.feature.LocatePlan = make_plan
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                tp.locate_tiled(image, 3, 12, noise_size=0.5)
+        finally:
+            tp.feature.LocatePlan = plan_class
+        tile_shapes = shapes[1:]  # the first validates the parameters
+        self.assertGreater(len(set(tile_shapes)), 8)
+        self.assertEqual(len(tile_shapes), len(set(tile_shapes)))
+
+    def test_topn(self):
+        all_features = tp.locate_tiled(self.image, 9, 100, minmass=1000)
+        actual = tp.locate_tiled(self.image, 9, 100, minmass=1000, topn=10)
+        self.assertEqual(len(actual), 10)
+        assert_allclose(np.sort(actual['mass']),
+                        np.sort(all_features['mass'])[-10:])
+
+
 class TestFeatureIdentificationWithVanillaNumpy(
     CommonFeatureIdentificationTests, unittest.TestCase):
 
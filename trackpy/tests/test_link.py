@@ -10,14 +10,16 @@ import pandas as pd
 from pandas import DataFrame, Series
 import unittest
 import nose
-from numpy.testing import assert_almost_equal, assert_allclose
+from numpy.testing import assert_almost_equal, assert_allclose, assert_equal
 from numpy.testing.decorators import slow
 from pandas.util.testing import (assert_series_equal, assert_frame_equal,
                                  assert_almost_equal, assert_produces_warning)
 
 import trackpy as tp
 from trackpy.try_numba import NUMBA_AVAILABLE
-from trackpy.linking import PointND, link, Hash_table
+from trackpy.linking import (PointND, link, Hash_table, _candidate_graph,
+                             _graph_from_pairs, _assign_links_array,
+                             _numba_link_array)
 from trackpy.utils import is_pandas_since_016, pandas_sort
 
 # Catch attempts to set values on an inadvertent copy of a Pandas object.
@@ -518,6 +520,19 @@ class SubnetNeededTests(CommonTrackingTests):
         trpos = self.link_df(subnet_test(-0.01), 5, retain_index=True)
         assert not np.allclose(trneg.particle.values, trpos.particle.values)
 
+    def test_dense_cluster(self):
+        # Each particle has 14 candidates, more than used to be queried
+        # or solved.
+        np.random.seed(0)
+        N = 14
+        pos0 = 10 + np.random.uniform(0, 1.5, (N, 2))
+        pos1 = pos0 + np.random.randn(N, 2) * 0.05
+        f = DataFrame({'x': np.append(pos0[:, 0], pos1[:, 0]),
+                       'y': np.append(pos0[:, 1], pos1[:, 1]),
+                       'frame': np.repeat([0, 1], N)})
+        actual = self.link_df(f, 3, retain_index=True)
+        assert_equal(actual.particle.values[N:], actual.particle.values[:N])
+
     def test_memory(self):
         """A unit-stepping trajectory and a random walk are observed
         simultaneously. The random walk is missing from one observation."""
@@ -746,6 +761,121 @@ class TestBTreeWithNumbaLink(NumbaOnlyTests, unittest.TestCase):
         self.linker_opts = dict(link_strategy='numba',
                                 neighbor_strategy='BTree')
 
+
+class TestCandidateGraph(unittest.TestCase):
+    def test_brute_force(self):
+        np.random.seed(0)
+        source = np.random.uniform(0, 20, (50, 2))
+        dest = np.random.uniform(0, 20, (60, 2))
+        dists = np.sqrt(np.sum((dest[:, np.newaxis] - source)**2, 2))
+        # With a search_range of 6, many particles have more than 10
+        # candidates.
+        for search_range in [3, 6]:
+            back, fwd = _candidate_graph(source, dest, search_range)
+            for (offsets, indices, distances), d in [(back, dists),
+                                                     (fwd, dists.T)]:
+                self.assertEqual(len(offsets), len(d) + 1)
+                for i in range(len(d)):
+                    expected = np.nonzero(d[i] < search_range)[0]
+                    expected = expected[np.argsort(d[i, expected])]
+                    sl = slice(offsets[i], offsets[i + 1])
+                    assert_equal(indices[sl], expected)
+                    assert_allclose(distances[sl], d[i, expected])
+
+    def test_subnets(self):
+        # Source 0 can only go to destination 0. Sources 1 and 2 compete
+        # for destination 2, and source 3 for destinations 3 and 4.
+        back, fwd = _graph_from_pairs(np.array([0, 2, 2, 3, 4]),
+                                      np.array([0, 1, 2, 3, 3]),
+                                      np.array([1., 2., 1., 1., 3.]), 5, 4)
+        match = np.full(5, -1, dtype=np.int64)
+        sizes = _assign_links_array(back, fwd, 5, match, _numba_link_array)
+        assert_equal(sorted(sizes), [1, 2])
+        assert_equal(match, [0, -1, 2, 3, -1])
+
+    def test_subnets_without_nogil(self):
+        # Numba < 0.18 cannot release the GIL: the subnets are solved in
+        # one thread.
+        n = 1000
+        sources = np.arange(n)
+        fwd = (np.arange(n + 1), np.arange(n), np.ones(n))
+        used_threads = []
+
+        def thread_map(func, items, threads):
+            used_threads.append(threads)
+            return orig_thread_map(func, items, threads)
+
+        orig_thread_map = tp.linking.thread_map
+        orig_nogil = tp.linking.NUMBA_NOGIL
+        tp.linking.thread_map = thread_map
+        tp.linking.NUMBA_NOGIL = False
+        try:
+            dests = _numba_link_array(sources, np.arange(n + 1), fwd, 2,
+                                      threads=3)
+        finally:
+            tp.linking.thread_map = orig_thread_map
+            tp.linking.NUMBA_NOGIL = orig_nogil
+        assert_equal(dests, np.arange(n))
+        self.assertEqual(used_threads, [1])
+
+
+class ArrayEngineTests(object):
+    """Mixin to link DataFrames with the 'array' engine of link_df."""
+    def link_df(self, *args, **kwargs):
+        kwargs['engine'] = 'array'
+        return super(ArrayEngineTests, self).link_df(*args, **kwargs)
+
+    def test_same_trajectories(self):
+        # Many random walkers, appearing and disappearing, in dense
+        # subnets: the same trajectories as the 'object' engine.
+        np.random.seed(0)
+        N, count = 20, 300
+        pos = np.random.uniform(0, 100, (count, 2)) + \
+            np.cumsum(np.random.randn(N, count, 2) * 0.5, axis=0)
+        f = DataFrame({'x': pos[..., 0].ravel(), 'y': pos[..., 1].ravel(),
+                       'frame': np.repeat(np.arange(N), count)})
+        f = f.drop(np.random.choice(len(f), len(f) // 10, replace=False))
+        for memory in [0, 2]:
+            opts = dict(self.linker_opts, memory=memory, retain_index=True)
+            expected = tp.link_df(f.copy(), 2, **opts)
+            actual = tp.link_df(f.copy(), 2, engine='array', **opts)
+            self.assertEqual(_trajectories(actual), _trajectories(expected))
+
+    def test_threads(self):
+        # Enough subnets per frame to be split over the threads.
+        np.random.seed(0)
+        N, count = 5, 3000
+        pos = np.random.uniform(0, 250, (count, 2)) + \
+            np.cumsum(np.random.randn(N, count, 2) * 0.5, axis=0)
+        f = DataFrame({'x': pos[..., 0].ravel(), 'y': pos[..., 1].ravel(),
+                       'frame': np.repeat(np.arange(N), count)})
+        opts = dict(self.linker_opts, retain_index=True)
+        expected = self.link_df(f.copy(), 2, **opts)
+        actual = self.link_df(f.copy(), 2, threads=3, **opts)
+        assert_equal(actual['particle'].values, expected['particle'].values)
+
+    def test_unsupported(self):
+        f = DataFrame({'x': [1.], 'y': [1.], 'frame': [0]})
+        self.assertRaises(ValueError, tp.link_df, f, 5, engine='array',
+                          diagnostics=True)
+        self.assertRaises(ValueError, tp.link_df, f, 5, engine='cython')
+        self.assertRaises(ValueError, tp.link_df, f, 5, engine='array',
+                          link_strategy='foo')
+
+
+def _trajectories(tracks):
+    "The set of trajectories, each as a set of the index of its features."
+    return set(frozenset(g.index) for _, g in tracks.groupby('particle'))
+
+
+class TestArrayWithNumbaLink(ArrayEngineTests, TestKDTreeWithNumbaLink):
+    pass
+
+
+class TestArrayWithDropLink(ArrayEngineTests, TestKDTreeWithDropLink):
+    pass
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=[__file__, '-vvs', '-x', '--pdb', '--pdb-failure'],
@@ -0,0 +1,103 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import six
+import unittest
+
+import numpy as np
+from numpy.testing import assert_equal
+from pims import Frame
+
+from trackpy import parallel
+from trackpy.parallel import (imap_frames, thread_map, validate_processes,
+                              validate_threads)
+
+
+def _summarize(image):
+    return image.frame_no, image.shape, int(image.sum())
+
+
+def _square(x):
+    return x**2
+
+
+_initialized = None
+
+
+def _initialize(value):
+    global _initialized
+    _initialized = value
+
+
+def _get_initialized(image):
+    return _initialized
+
+
+class TestImapFrames(unittest.TestCase):
+    def setUp(self):
+        self.frames = [np.full((5, 7), i, dtype=np.uint16) for i in range(9)]
+        self.expected = [(i, (5, 7), 35*i) for i in range(9)]
+
+    def test_serial(self):
+        actual = list(imap_frames(_summarize, self.frames, processes=1))
+        self.assertEqual(actual, self.expected)
+
+    def test_processes(self):
+        actual = list(imap_frames(_summarize, self.frames, processes=2,
+                                  ring_size=3))
+        self.assertEqual(actual, self.expected)
+
+    def test_frame_no(self):
+        frames = [Frame(f, frame_no=i + 10) for i, f in enumerate(self.frames)]
+        actual = list(imap_frames(_summarize, frames, processes=2))
+        assert_equal([a[0] for a in actual], np.arange(10, 19))
+
+    def test_shape_change(self):
+        # Images that do not fit the shared slots are sent the usual way.
+        frames = self.frames[:3] + [np.ones((3, 3), dtype=np.uint8)]
+        actual = list(imap_frames(_summarize, frames, processes=2))
+        self.assertEqual(actual, self.expected[:3] + [(3, (3, 3), 9)])
+
+    def test_empty(self):
+        self.assertEqual(list(imap_frames(_summarize, [], processes=2)), [])
+
+    def test_initializer(self):
+        actual = list(imap_frames(_get_initialized, self.frames, processes=2,
+                                  initializer=_initialize, initargs=(5,)))
+        self.assertEqual(actual, [5] * len(self.frames))
+        self.assertIsNone(_initialized)
+
+    def test_validate_processes(self):
+        self.assertEqual(validate_processes(2), 2)
+        self.assertGreaterEqual(validate_processes('auto'), 1)
+        self.assertRaises(ValueError, validate_processes, 0)
+
+
+class TestThreadMap(unittest.TestCase):
+    def test_order(self):
+        for threads in [1, 3]:
+            actual = thread_map(_square, range(20), threads)
+            self.assertEqual(actual, [x**2 for x in range(20)])
+
+    def test_one_pool(self):
+        # Another number of threads replaces the pool, and closes the old one.
+        thread_map(_square, range(20), 2)
+        pool = parallel._thread_pool[2]
+        self.assertEqual(thread_map(_square, range(20), 3),
+                         [x**2 for x in range(20)])
+        self.assertEqual(parallel._thread_pool[1], 3)
+        # Python 2 asserts that the pool runs, Python 3 raises ValueError.
+        self.assertRaises((ValueError, AssertionError), pool.apply_async,
+                          _square, (1,))
+        parallel._close_thread_pool()
+        self.assertIsNone(parallel._thread_pool)
+
+    def test_validate_threads(self):
+        self.assertEqual(validate_threads(2), 2)
+        self.assertGreaterEqual(validate_threads('auto'), 1)
+        self.assertRaises(ValueError, validate_threads, 0)
+
+
+if __name__ == '__main__':
+    import nose
+    nose.runmodule(argv=[__file__, '-vvs', '-x', '--pdb', '--pdb-failure'],
+                   exit=False)
@@ -1,6 +1,8 @@
 from __future__ import division
 import nose
-from numpy.testing.utils import assert_allclose
+from nose.tools import assert_raises
+import numpy as np
+from numpy.testing.utils import assert_allclose, assert_equal
 from trackpy.preprocessing import *
 from trackpy.artificial import gen_nonoverlapping_locations, draw_spots
 
@@ -24,6 +26,167 @@ def test_legacy_bandpass_fftw():
     lbp_fftw = legacy_bandpass_fftw(frame, 3, 11)[margin:-margin, margin:-margin]
     assert_allclose(lbp_fftw, bp_scipy, atol=1.1)
 
+
+def test_bandpass_float32():
+    bp_float32 = bandpass(frame, 3, 11, dtype=np.float32)
+    assert bp_float32.dtype == np.float32
+    assert_allclose(bp_float32[margin:-margin, margin:-margin], bp_scipy,
+                    rtol=1e-5, atol=1e-3)
+
+
+def test_bandpass_fft():
+    for lshort, llong in [(3, 11), ((1, 6), (13, 21))]:
+        expected = bandpass(frame, lshort, llong, engine='scipy')
+        actual = bandpass(frame, lshort, llong, engine='fft')
+        assert_allclose(actual, expected, atol=1e-8)
+    assert_raises(ValueError, bandpass, frame, 3, 11, engine='fftw')
+
+
+def test_bandpass_numba():
+    from trackpy.try_numba import NUMBA_AVAILABLE
+    if not NUMBA_AVAILABLE:
+        raise nose.SkipTest("Numba not installed. Skipping.")
+    stack = np.array([frame[:100, :150], frame[100:200, 200:350]])
+    for image, lshort, llong in [(frame, 3, 11), (frame, (1, 6), (13, 21)),
+                                 (stack, (0, 1, 2), (1, 7, 9))]:
+        expected = bandpass(image, lshort, llong, engine='scipy')
+        for threads in [1, 3]:
+            actual = bandpass(image, lshort, llong, engine='numba',
+                              threads=threads)
+            assert_allclose(actual, expected, atol=1e-8)
+
+
+def test_bandpass_numba_without_nogil():
+    # Numba < 0.18 cannot release the GIL: the filters use one thread.
+    import trackpy.preprocessing as preprocessing
+    if not preprocessing.NUMBA_AVAILABLE:
+        raise nose.SkipTest("Numba not installed. Skipping.")
+    expected = bandpass(frame, 3, 11, engine='scipy')
+    used_threads = []
+
+    def thread_map(func, items, threads):
+        used_threads.append(threads)
+        return orig_thread_map(func, items, threads)
+
+    orig_thread_map = preprocessing.thread_map
+    orig_nogil = preprocessing.NUMBA_NOGIL
+    preprocessing.thread_map = thread_map
+    preprocessing.NUMBA_NOGIL = False
+    try:
+        actual = bandpass(frame, 3, 11, engine='numba', threads=3)
+    finally:
+        preprocessing.thread_map = orig_thread_map
+        preprocessing.NUMBA_NOGIL = orig_nogil
+    assert_allclose(actual, expected, atol=1e-8)
+    assert len(used_threads) > 0
+    assert all(threads == 1 for threads in used_threads)
+
+
+def _exact_boxcar(image, llong):
+    # The truncated average over each window, from cumulative sums.
+    result = image
+    for axis, smoothing in enumerate(llong):
+        if smoothing > 1:
+            size = 2*smoothing + 1
+            padded = np.concatenate(
+                [np.take(result, [0] * smoothing, axis), result,
+                 np.take(result, [-1] * smoothing, axis)], axis)
+            sums = np.cumsum(padded.astype(np.int64), axis)
+            zero = np.zeros_like(np.take(sums, [0], axis))
+            sums = np.concatenate([zero, sums], axis)
+            n = result.shape[axis]
+            window = (np.take(sums, np.arange(size, size + n), axis) -
+                      np.take(sums, np.arange(n), axis))
+            result = (window // size).astype(image.dtype)
+    return result
+
+
+def test_boxcar_integer():
+    # The integer running sums give the exact truncated average. scipy's
+    # floating-point running mean may be off by one from it.
+    from scipy.ndimage.filters import uniform_filter1d
+    from trackpy.preprocessing import _boxcar_filter
+    from trackpy.try_numba import NUMBA_AVAILABLE
+    if not NUMBA_AVAILABLE:
+        raise nose.SkipTest("Numba not installed. Skipping.")
+    np.random.seed(0)
+    for dtype in [np.uint8, np.uint16]:
+        smooth = (frame[:, :300] / frame.max() *
+                  np.iinfo(dtype).max).astype(dtype)
+        noise = np.random.randint(0, np.iinfo(dtype).max + 1,
+                                  (200, 173)).astype(dtype)
+        for image in [smooth, noise]:
+            for llong in [(11, 11), (1, 6), (2, 3), (5, 40), (150, 120)]:
+                expected = image
+                for axis, smoothing in enumerate(llong):
+                    if smoothing > 1:
+                        expected = uniform_filter1d(expected, 2*smoothing+1,
+                                                    axis, mode='nearest')
+                actual = np.empty_like(image)
+                _boxcar_filter(image, llong, actual, 'numba', 1)
+                assert_equal(actual, _exact_boxcar(image, llong))
+                assert_allclose(actual, expected, atol=1)
+
+
+def test_boxcar_engine():
+    # Only the numba engine takes the integer path.
+    import trackpy.preprocessing as preprocessing
+    integer_kernel = preprocessing._numba_boxcar_lines_integer
+
+    def fail(*args):
+        raise AssertionError("The integer kernel was used.")
+
+    preprocessing._numba_boxcar_lines_integer = fail
+    try:
+        for engine in ['auto', 'scipy', 'fft']:
+            bandpass(frame, 3, 11, engine=engine)
+        result = np.empty(frame.shape, dtype=np.float64)
+        scaled = np.empty_like(frame)
+        preprocessing._bandpass_to_gamut(frame, (3, 3), (11, 11), 1, 4,
+                                         result, np.empty_like(frame),
+                                         scaled, 'python')
+    finally:
+        preprocessing._numba_boxcar_lines_integer = integer_kernel
+
+
+def test_bandpass_to_gamut():
+    from trackpy.preprocessing import _bandpass_to_gamut
+    from trackpy.try_numba import NUMBA_AVAILABLE
+    expected = scale_to_gamut(bandpass(frame, 3, 11), frame.dtype)
+    engines = ['python', 'numba'] if NUMBA_AVAILABLE else ['python']
+    for engine in engines:
+        result = np.empty(frame.shape, dtype=np.float64)
+        boxcar = np.empty_like(frame)
+        scaled = np.empty_like(frame)
+        _bandpass_to_gamut(frame, (3, 3), (11, 11), 1, 4, result, boxcar,
+                           scaled, engine)
+        assert_allclose(scaled, expected, atol=1)
+
+
+def test_bandpass_to_gamut_spatial():
+    # locate keeps the spatial filter, also where bandpass picks the FFT.
+    import trackpy.preprocessing as preprocessing
+    assert preprocessing._choose_gaussian_engine(frame.shape, (16, 16),
+                                                 4) == 'fft'
+    expected = bandpass(frame, 16, 35, engine='scipy')
+    expected = scale_to_gamut(expected, frame.dtype)
+    fft_gaussian = preprocessing._fft_gaussian
+
+    def fail(*args):
+        raise AssertionError("The FFT engine was used.")
+
+    preprocessing._fft_gaussian = fail
+    try:
+        result = np.empty(frame.shape, dtype=np.float64)
+        scaled = np.empty_like(frame)
+        preprocessing._bandpass_to_gamut(frame, (16, 16), (35, 35), 1, 4,
+                                         result, np.empty_like(frame),
+                                         scaled, 'python')
+    finally:
+        preprocessing._fft_gaussian = fft_gaussian
+    assert_equal(scaled, expected)
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=[__file__, '-vvs', '-x', '--pdb', '--pdb-failure'],
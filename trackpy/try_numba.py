@@ -24,6 +24,7 @@ ENABLE_NUMBA_ON_IMPORT = True
 _registered_functions = list()  # functions that can be numba-compiled
 
 NUMBA_AVAILABLE = False
+NUMBA_NOGIL = False  # whether numba can compile functions that release the GIL
 
 try:
     import numba
@@ -42,6 +43,8 @@ else:
         warn(message)
     else:
         NUMBA_AVAILABLE = True
+        # The nogil option was added in numba 0.18.
+        NUMBA_NOGIL = (int(major), int(minor)) >= (0, 18)
         _hush_llvm()
 
 
@@ -89,7 +92,12 @@ def try_numba_autojit(func=None, **kw):
     arguments.
 
     The resulting compiled numba function can subsequently be turned on or off with
-    enable_numba() and disable_numba(). It will be on by default."""
+    enable_numba() and disable_numba(). It will be on by default.
+
+    Pass nogil=NUMBA_NOGIL rather than nogil=True: a false nogil is left out,
+    because numba < 0.18 rejects it."""
+    if not kw.get('nogil', True):
+        del kw['nogil']
     def return_decorator(func):
         # Register the function with a global list of numba-enabled functions.
         f = RegisteredFunction(func, autojit_kw=kw)